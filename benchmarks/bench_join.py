@@ -0,0 +1,74 @@
+"""Micro-benchmark: TripDataset.data_merge indexed join vs the old two inner pd.merge calls.
+
+    python -m benchmarks.bench_join --rows 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault('JOIN_REPORT_FOLDER', tempfile.mkdtemp(prefix='adv_join_'))
+
+from utils.join import KeyedLookup, join_lookups  # noqa: E402
+from utils.schema import apply_schema  # noqa: E402
+
+
+def make_frames(rows: int, drivers: int = 5000, miss: float = 0.02, seed: int = 0):
+    """Выгрузка на rows строк и lookup, в которых нет доли miss грузов и водителей."""
+    rng = np.random.default_rng(seed)
+    loads = np.arange(1000000, 1000000 + rows).astype(str)
+    driver_ids = np.arange(1000, 1000 + drivers).astype(str)
+    df = apply_schema(pd.DataFrame({
+        'load': loads,
+        'driver_id': driver_ids[rng.integers(0, drivers, rows)],
+        'status': rng.choice(['Delivered', 'Dispatched'], rows),
+        'linehaul_total': rng.uniform(300, 6000, rows),
+    }))
+    known_loads = loads[rng.random(rows) >= miss]
+    stops = apply_schema(pd.DataFrame({'load': known_loads, 'pickup_id': 'a0P' + known_loads,
+                                       'delivery_id': 'a0D' + known_loads}))
+    known_drivers = driver_ids[rng.random(drivers) >= miss]
+    vehicles = apply_schema(pd.DataFrame({'driver_id': known_drivers, 'vehicle_type': 'TRUCK',
+                                          'unit_id': 'R' + known_drivers, 'vehicle_id': 'a0T' + known_drivers}))
+    return df, stops, vehicles
+
+
+def merge_path(df, stops, vehicles):
+    return pd.merge(pd.merge(df, stops, on='load', how='inner'), vehicles, on='driver_id', how='inner')
+
+
+def indexed_path(df, stops, vehicles):
+    return join_lookups(df, [KeyedLookup(stops, 'load', 'stop_lookup'), KeyedLookup(vehicles, 'driver_id', 'driver_lookup')])
+
+
+def measure(func, *frames):
+    """Время без tracemalloc (он замедляет pandas в разы), пик памяти — отдельным прогоном."""
+    started = time.perf_counter()
+    result = func(*frames)
+    seconds = time.perf_counter() - started
+    tracemalloc.start()
+    func(*frames)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+    args = parser.parse_args()
+    for rows in args.rows:
+        frames = make_frames(rows)
+        merged, merge_seconds, merge_peak = measure(merge_path, *frames)
+        joined, join_seconds, join_peak = measure(indexed_path, *frames)
+        same = merged.sort_values('load').reset_index(drop=True).equals(joined[merged.columns].sort_values('load').reset_index(drop=True))
+        print(f"rows={rows} merge={merge_seconds:.3f}s/{merge_peak:.0f}MB indexed={join_seconds:.3f}s/{join_peak:.0f}MB "
+              f"kept={len(joined)} same_rows={same}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Micro-benchmark: vectorized DataSet.set_df normalization vs the old per-row path.
+
+    python -m benchmarks.bench_normalize --rows 100000
+"""
+import argparse
+import os
+import re
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.address_index import AddressResolver
+from utils.normalize import normalize_columns, add_appointment_columns
+
+
+def make_frame(rows: int, seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    loads = rng.integers(100000, 999999, rows).astype(str)
+    drivers = rng.integers(1000, 9999, rows).astype(str)
+    return pd.DataFrame({
+        'customer': [f'AMAZON LOGISTICS {n}' for n in loads],
+        'pu_info': 'JOLIET, IL 60436',
+        'pu_state_code': 'IL',
+        'del_info': 'DALLAS, TX 75201',
+        'del_state_code': 'TX',
+        'driver': [f'{d} - John Smith (100.0%)' for d in drivers],
+        'pu_time': '12/05/2024 08:00 - 16:00CST',
+        'del_time': '12/07/2024 22:00 - 02:00CST',
+    })
+
+
+def legacy_parse_date(pu_time):
+    if not pu_time or not isinstance(pu_time, str):
+        return None
+    match = re.match(
+        r'(?P<date>(?P<month>\d{2})/(?P<day>\d{2})/(?P<year>\d{4}))\s+'
+        r'(?P<start_time>\d+:\d+)\s*-\s*(?P<end_time>\d+:\d+)(?P<timezone>[A-Z]+)',
+        pu_time
+    )
+    return match.groupdict() if match else None
+
+
+def legacy_appointment_date(pu_time):
+    parsed = legacy_parse_date(pu_time)
+    if not parsed:
+        return [None, None]
+    return [f"{parsed['year']}-{parsed['month']}-{parsed['day']}T{parsed['start_time']}:00",
+            f"{parsed['year']}-{parsed['month']}-{parsed['day']}T{parsed['end_time']}:00"]
+
+
+def legacy_path(df: pd.DataFrame):
+    """Per-row .apply passes and three regex parses per row, as the pipeline did before."""
+    df['load'] = df['customer'].apply(lambda i: i.split(' ')[-1] if pd.notna(i) else '')
+    df['customer'] = df['customer'].apply(lambda i: " ".join(i.split(' ')[:-1]) if pd.notna(i) else '')
+    df['pu_city'] = df['pu_info'].apply(lambda i: i.split(', ')[0] if pd.notna(i) else '')
+    df['del_city'] = df['del_info'].apply(lambda i: i.split(', ')[0] if pd.notna(i) else '')
+    df['driver_id'] = df['driver'].apply(lambda i: i.split(' - ')[0] if pd.notna(i) else '')
+    df['driver'] = df['driver'].apply(lambda i: i.split(' - ')[1].replace(' (100.0%)', '') if pd.notna(i) and ' - ' in i else '')
+    for _, row in df.iterrows():
+        legacy_appointment_date(row['pu_time'])[0]
+        legacy_appointment_date(row['pu_time'])[1]
+        legacy_appointment_date(row['pu_time'])[0]
+    return df
+
+
+def vectorized_path(df: pd.DataFrame, resolver: AddressResolver):
+    return resolver.add_address_columns(add_appointment_columns(normalize_columns(df)))
+
+
+def timed(func, df: pd.DataFrame, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        frame = df.copy()
+        started = time.perf_counter()
+        func(frame)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_frame(args.rows)
+    legacy = timed(legacy_path, df, args.repeat)
+    resolver = AddressResolver(memo_path=os.path.join(tempfile.mkdtemp(), 'address_memo.json'))
+    vectorized = timed(lambda frame: vectorized_path(frame, resolver), df, args.repeat)
+    print(f"rows={args.rows} legacy={legacy:.3f}s vectorized={vectorized:.3f}s speedup={legacy / vectorized:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Startup budget of main.py: a run with no exports in temp/ must exit without pandas, Salesforce clients or login.
+
+    python -m benchmarks.bench_startup --runs 10 --budget-ms 300
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(REPO_ROOT, 'main.py')
+# Модули, которые пустой запуск не должен импортировать
+HEAVY_MODULES = ('pandas', 'numpy', 'pyarrow', 'simple_salesforce', 'salesforce_bulk', 'requests')
+STARTUP_BUDGET_MS = float(os.getenv('STARTUP_BUDGET_MS', '300'))
+
+
+def timed_run(args, cwd: str, env: dict) -> float:
+    started = time.perf_counter()
+    subprocess.run([sys.executable, *args], cwd=cwd, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.perf_counter() - started) * 1000
+
+
+def imported_modules(args, cwd: str, env: dict) -> set:
+    """Корневые пакеты, импортированные процессом, по выводу -X importtime."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', *args], cwd=cwd, env=env,
+                            capture_output=True, text=True, check=True)
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            modules.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS,
+                        help='median wall time allowed for an empty run, interpreter startup included')
+    args = parser.parse_args()
+
+    # Пустая рабочая папка: нет temp/, нет .env, логин невозможен — запуск обязан закончиться раньше него
+    work_dir = tempfile.mkdtemp(prefix='adv_startup_')
+    env = {key: value for key, value in os.environ.items() if not key.startswith('SALESFORCE_')}
+    env['PYTHONPATH'] = REPO_ROOT
+    cases = {'interpreter': ['-c', 'pass'], 'main.py --help': [MAIN, '--help'], 'main.py (no exports)': [MAIN]}
+
+    failed = False
+    for name, command in cases.items():
+        timed_run(command, work_dir, env)
+        median = statistics.median(timed_run(command, work_dir, env) for _ in range(args.runs))
+        heavy = sorted(imported_modules(command, work_dir, env) & set(HEAVY_MODULES))
+        over = name != 'interpreter' and median > args.budget_ms
+        failed |= over or bool(heavy)
+        print(f"{name:<22} median={median:.0f}ms budget={args.budget_ms:.0f}ms heavy_imports={heavy or '-'}"
+              f"{' OVER BUDGET' if over else ''}")
+    if os.path.exists(os.path.join(work_dir, 'temp')):
+        print('main.py created temp/ on an empty run')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+"""Local stand-in for the Salesforce REST query and Bulk API (upload and query) endpoints used by the pipelines.
+
+    python -m benchmarks.fake_salesforce --port 8555 --latency 0.05
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from requests.adapters import HTTPAdapter
+
+JOB_NS = 'http://www.force.com/2009/06/asyncapi/dataload'
+QUERY_PAGE_SIZE = 2000
+IN_PATTERN = re.compile(r"\bIN\s*\(([^)]*)\)", re.IGNORECASE)
+
+
+def soql_in_values(soql: str):
+    match = IN_PATTERN.search(soql)
+    if not match:
+        return []
+    return [value.strip().strip("'") for value in match.group(1).split(',') if value.strip()]
+
+
+def subquery(records):
+    return {'totalSize': len(records), 'done': True, 'records': records}
+
+
+class FakeSalesforce:
+    """Состояние фейковой org: курсоры query_more, Bulk job'ы и батчи."""
+
+    def __init__(self, latency: float = 0.0, batch_time: float = 0.0, loads=()):
+        self.latency = latency
+        self.batch_time = batch_time
+        # Грузы, стопы которых отдаёт Bulk query по Stop_Position__c
+        self.loads = list(loads)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.cursors = {}
+        self.jobs = {}
+        self.batches = {}
+        self.chunk_sizes = {}
+
+    def new_id(self, prefix: str) -> str:
+        with self.lock:
+            return f'{prefix}{next(self.ids):015d}'
+
+    def query_records(self, soql: str):
+        values = soql_in_values(soql)
+        if 'FROM Load__c' in soql:
+            return [{
+                'attributes': {'type': 'Load__c'}, 'Id': f'a0L{value}', 'Load_Number__c': value,
+                'Stop_Positions__r': subquery([
+                    {'attributes': {'type': 'Stop_Position__c'}, 'Id': f'a0P{value}', 'TYPE__c': 'Pickup'},
+                    {'attributes': {'type': 'Stop_Position__c'}, 'Id': f'a0D{value}', 'TYPE__c': 'Delivery'},
+                ]),
+            } for value in values]
+        if 'DRIVER_ID__c' in soql:
+            return [{
+                'attributes': {'type': 'Account'}, 'Id': f'001{value}', 'DRIVER_ID__c': value,
+                'FirstName': 'Driver', 'LastName': value,
+                'Vehicle_History__r': subquery([
+                    {'attributes': {'type': 'Vehicle_History__c'}, 'Id': f'a0T{value}', 'TYPE__c': 'TRUCK',
+                     'END_DATE__c': None, 'UNIT__c': f'T{value}'},
+                    {'attributes': {'type': 'Vehicle_History__c'}, 'Id': f'a0R{value}', 'TYPE__c': 'TRAILER',
+                     'END_DATE__c': None, 'UNIT__c': f'R{value}'},
+                ]),
+            } for value in values]
+        return []
+
+    def query_page(self, version: str, records, cursor: str = None, offset: int = 0) -> dict:
+        page = records[offset:offset + QUERY_PAGE_SIZE]
+        done = offset + QUERY_PAGE_SIZE >= len(records)
+        result = {'totalSize': len(records), 'done': done, 'records': page}
+        if not done:
+            cursor = cursor or self.new_id('01g')
+            with self.lock:
+                self.cursors[cursor] = records
+            result['nextRecordsUrl'] = f'/services/data/v{version}/query/{cursor}-{offset + QUERY_PAGE_SIZE}'
+        return result
+
+    def create_job(self, body: bytes, pk_chunking: str = None) -> dict:
+        doc = ET.fromstring(body)
+        job = {
+            'id': self.new_id('750'),
+            'object': doc.findtext(f'{{{JOB_NS}}}object'),
+            'operation': doc.findtext(f'{{{JOB_NS}}}operation'),
+            'contentType': doc.findtext(f'{{{JOB_NS}}}contentType') or 'CSV',
+            'state': 'Open',
+        }
+        with self.lock:
+            self.jobs[job['id']] = job
+            if pk_chunking:
+                size = re.search(r'chunkSize=(\d+)', pk_chunking)
+                self.chunk_sizes[job['id']] = int(size.group(1)) if size else 100000
+        return job
+
+    def add_batch(self, job_id: str, body: bytes) -> dict:
+        rows = list(csv.reader(io.StringIO(body.decode('utf-8'))))
+        batch = {'id': self.new_id('751'), 'jobId': job_id, 'records': max(len(rows) - 1, 0),
+                 'created': time.monotonic()}
+        with self.lock:
+            self.batches[batch['id']] = batch
+        return batch
+
+    def bulk_query_rows(self, soql: str):
+        if 'FROM Stop_Position__c' in soql:
+            header = ['Id', 'TYPE__c', 'LOAD__r.Load_Number__c']
+            rows = [row for load in self.loads
+                    for row in ((f'a0P{load}', 'Pickup', load), (f'a0D{load}', 'Delivery', load))]
+            return header, rows
+        return ['Id'], []
+
+    def add_query_batch(self, job_id: str, soql: str) -> dict:
+        """С PK chunking исходный батч получает NotProcessed, а строки раскладываются по батчам-кускам."""
+        header, rows = self.bulk_query_rows(soql)
+        original = {'id': self.new_id('751'), 'jobId': job_id, 'records': len(rows), 'header': header,
+                    'rows': rows, 'created': time.monotonic()}
+        batches = [original]
+        pk_chunk_size = self.chunk_sizes.get(job_id)
+        if pk_chunk_size:
+            original.update(rows=[], records=0, state='NotProcessed')
+            for start in range(0, max(len(rows), 1), pk_chunk_size):
+                part = rows[start:start + pk_chunk_size]
+                batches.append({'id': self.new_id('751'), 'jobId': job_id, 'records': len(part), 'header': header,
+                                'rows': part, 'created': time.monotonic()})
+        with self.lock:
+            for batch in batches:
+                self.batches[batch['id']] = batch
+        return original
+
+    def batch_info(self, batch: dict) -> dict:
+        state = batch.get('state') or self.batch_state(batch)
+        return {'id': batch['id'], 'jobId': batch['jobId'], 'state': state,
+                'numberRecordsProcessed': batch['records'] if state == 'Completed' else 0,
+                'numberRecordsFailed': 0}
+
+    def batch_state(self, batch: dict) -> str:
+        return 'Completed' if time.monotonic() - batch['created'] >= self.batch_time else 'InProgress'
+
+
+def xml_response(tag: str, fields: dict) -> bytes:
+    root = ET.Element(tag, xmlns=JOB_NS)
+    for key, value in fields.items():
+        ET.SubElement(root, key).text = str(value)
+    return ET.tostring(root, encoding='utf-8')
+
+
+def xml_list(tag: str, item_tag: str, items) -> bytes:
+    root = ET.Element(tag, xmlns=JOB_NS)
+    for item in items:
+        child = ET.SubElement(root, item_tag)
+        if isinstance(item, dict):
+            for key, value in item.items():
+                ET.SubElement(child, key).text = str(value)
+        else:
+            child.text = str(item)
+    return ET.tostring(root, encoding='utf-8')
+
+
+def csv_text(header, rows) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(header)
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    org: FakeSalesforce = None
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status: int, body: bytes, content_type: str):
+        time.sleep(self.org.latency)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts[:2] == ['services', 'data']:
+            version = parts[2].lstrip('v')
+            if len(parts) == 3:
+                return self.send(200, b'{}', 'application/json')
+            if parts[3] == 'query' and len(parts) == 5:
+                cursor, offset = parts[4].rsplit('-', 1)
+                records = self.org.cursors.get(cursor, [])
+                return self.send(200, json.dumps(self.org.query_page(version, records, cursor, int(offset))).encode(),
+                                 'application/json')
+            if parts[3] == 'query':
+                soql = parse_qs(url.query).get('q', [''])[0]
+                page = self.org.query_page(version, self.org.query_records(soql))
+                return self.send(200, json.dumps(page).encode(), 'application/json')
+        if parts[:2] == ['services', 'async'] and len(parts) == 6 and parts[5] == 'batch':
+            batches = [self.org.batch_info(b) for b in list(self.org.batches.values()) if b['jobId'] == parts[4]]
+            return self.send(200, xml_list('batchInfoList', 'batchInfo', batches), 'application/xml')
+        if parts[:2] == ['services', 'async'] and len(parts) > 6 and parts[5] == 'batch':
+            batch = self.org.batches.get(parts[6])
+            if batch is None:
+                return self.send(404, b'', 'text/plain')
+            if len(parts) == 8 and parts[7] == 'result' and 'rows' in batch:
+                return self.send(200, xml_list('result-list', 'result', [f'752{batch["id"][3:]}']), 'application/xml')
+            if len(parts) == 9 and parts[7] == 'result':
+                return self.send(200, csv_text(batch['header'], batch['rows']), 'text/csv')
+            if len(parts) == 8 and parts[7] == 'result':
+                lines = ['"Id","Success","Created","Error"']
+                lines += [f'"{self.org.new_id("a00")}","true","true",""' for _ in range(batch['records'])]
+                return self.send(200, ('\n'.join(lines) + '\n').encode(), 'text/csv')
+            return self.send(200, xml_response('batchInfo', self.org.batch_info(batch)), 'application/xml')
+        if parts[:2] == ['services', 'async'] and len(parts) == 5:
+            job = self.org.jobs.get(parts[4])
+            if job:
+                return self.send(200, xml_response('jobInfo', job), 'application/xml')
+        self.send(404, b'', 'text/plain')
+
+    def do_POST(self):
+        parts = urlparse(self.path).path.strip('/').split('/')
+        body = self.body()
+        if parts[:2] == ['services', 'async'] and parts[3:] == ['job']:
+            job = self.org.create_job(body, self.headers.get('Sforce-Enable-PKChunking'))
+            return self.send(201, xml_response('jobInfo', job), 'application/xml')
+        if parts[:2] == ['services', 'async'] and len(parts) == 5:
+            job = self.org.jobs.get(parts[4])
+            if job is None:
+                return self.send(404, b'', 'text/plain')
+            state = ET.fromstring(body).findtext(f'{{{JOB_NS}}}state')
+            if state:
+                job['state'] = state
+            return self.send(200, xml_response('jobInfo', job), 'application/xml')
+        if parts[:2] == ['services', 'async'] and len(parts) == 6 and parts[5] == 'batch':
+            job = self.org.jobs.get(parts[4], {})
+            if job.get('operation') == 'query':
+                batch = self.org.add_query_batch(parts[4], body.decode('utf-8'))
+                return self.send(201, xml_response('batchInfo', self.org.batch_info(batch)), 'application/xml')
+            if job.get('state') != 'Open':
+                # Как Salesforce: в закрытый job батчи не принимаются
+                return self.send(400, xml_response('error', {'exceptionCode': 'InvalidJobState',
+                                                             'exceptionMessage': 'Closed'}), 'application/xml')
+            batch = self.org.add_batch(parts[4], body)
+            return self.send(201, xml_response('batchInfo', {'id': batch['id'], 'jobId': batch['jobId'],
+                                                              'state': 'Queued'}), 'application/xml')
+        self.send(404, b'', 'text/plain')
+
+
+class HttpsToHttpAdapter(HTTPAdapter):
+    """Клиенты строят https:// URL из instance; фейковый сервер слушает обычный http."""
+
+    def send(self, request, **kwargs):
+        request.url = 'http://' + request.url[len('https://'):]
+        return super().send(request, **kwargs)
+
+
+def start_server(port: int = 0, latency: float = 0.0, batch_time: float = 0.0, loads=()):
+    """Запускает сервер в фоне и возвращает (server, instance) для Salesforce(instance=...)."""
+    handler = type('FakeHandler', (Handler,), {'org': FakeSalesforce(latency, batch_time, loads)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-salesforce', daemon=True).start()
+    return server, f'127.0.0.1:{server.server_port}'
+
+
+def connect(instance: str):
+    """Подключает SalesforceAuthentication к фейковому серверу без логина."""
+    from utils.metrics import instrument_http_session
+    from utils.salesforce_interfrnc import SalesforceAuthentication
+    from utils.sf_session import create_http_session
+
+    session = create_http_session()
+    session.mount(f'https://{instance}', HttpsToHttpAdapter(pool_connections=16, pool_maxsize=16))
+    instrument_http_session(session)
+    SalesforceAuthentication.http_session = session
+    SalesforceAuthentication.sf_rest_session, SalesforceAuthentication.sf_bulk_session = \
+        SalesforceAuthentication.build_clients('FAKE_SESSION', instance)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8555)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--batch-time', type=float, default=0.0, help='seconds a bulk batch stays InProgress')
+    args = parser.parse_args()
+    server, instance = start_server(args.port, args.latency, args.batch_time)
+    print(f'Fake Salesforce listening on http://{instance}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""End-to-end benchmark of the LoadRecord, PickupDelivery and Trip pipelines against a local fake Salesforce.
+
+    python -m benchmarks.run_pipeline --rows 1000 10000 --latency 0.02
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+WORK_DIR = tempfile.mkdtemp(prefix='adv_bench_')
+# Кэши и журналы бенчмарка не должны смешиваться с рабочими в set/
+os.environ.setdefault('LEDGER_DB_PATH', os.path.join(WORK_DIR, 'ledger.sqlite'))
+os.environ.setdefault('REFERENCE_DB_PATH', os.path.join(WORK_DIR, 'reference.sqlite'))
+os.environ.setdefault('BULK_REJECTS_FOLDER', os.path.join(WORK_DIR, 'rejects'))
+os.environ.setdefault('METRICS_REPORT_FOLDER', os.path.join(WORK_DIR, 'reports'))
+os.environ.setdefault('ADDRESS_MEMO_PATH', os.path.join(WORK_DIR, 'address_memo.json'))
+os.environ.setdefault('DELTA_UPLOADS', 'false')
+os.environ.setdefault('BULK_POLL_INTERVAL', '0.2')
+
+from benchmarks.fake_salesforce import connect, start_server  # noqa: E402
+from benchmarks.synth_exports import generate_pair, load_number  # noqa: E402
+from utils.dataset_cache import ParsedDatasetCache  # noqa: E402
+from utils.job import DataSet, LoadRecord, PickupDelivery, Trip  # noqa: E402
+from utils.metrics import metrics  # noqa: E402
+import utils.job  # noqa: E402
+from utils import configure  # noqa: E402
+
+
+class StageProbe:
+    """Время и пик памяти (tracemalloc) каждой стадии."""
+
+    def __init__(self, trace_memory: bool):
+        self.trace_memory = trace_memory
+        self.results = []
+
+    def run(self, name: str, func):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] - base if self.trace_memory else None
+        self.results.append({'stage': name, 'seconds': round(seconds, 4),
+                             'peak_mb': round(peak / 2 ** 20, 1) if peak is not None else None})
+        return result
+
+
+def bench(files, trace_memory: bool) -> list:
+    probe = StageProbe(trace_memory)
+    # Каждый прогон парсит Excel заново, кэш разбора живёт во временной папке
+    utils.job.dataset_cache = ParsedDatasetCache(os.path.join(WORK_DIR, 'cache', str(time.time_ns())))
+    probe.run('dataset.parse', lambda: DataSet(files))
+    probe.run('load.upload', lambda: LoadRecord(files).process_load_records())
+    probe.run('stops.upload', lambda: PickupDelivery(files).picup_dlvr_loader())
+    trip = probe.run('trip.dataset', lambda: Trip(files, WORK_DIR, prepare=False))
+    probe.run('trip.stop_lookup', trip.fetch_stop_lookup)
+    probe.run('trip.driver_lookup', trip.fetch_driver_lookup)
+    probe.run('trip.merge', trip.data_merge)
+    probe.run('trip.upload', trip.process_trip_records)
+    return probe.results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--data', default='benchmarks/data', help='folder for generated exports (reused between runs)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake Salesforce response')
+    parser.add_argument('--batch-time', type=float, default=0.0, help='seconds a bulk batch stays InProgress')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracemalloc (it slows pandas down)')
+    parser.add_argument('--report', help='write the JSON report here')
+    args = parser.parse_args()
+    configure()
+
+    # Stop_Position__c для Bulk query: все грузы, которые могут попасть в сгенерированные выгрузки
+    loads = [load_number(i) for i in range(max(args.rows))]
+    server, instance = start_server(latency=args.latency, batch_time=args.batch_time, loads=loads)
+    connect(instance)
+    if not args.no_memory:
+        tracemalloc.start()
+
+    report = []
+    for rows in args.rows:
+        files = generate_pair(args.data, rows)
+        metrics.reset()
+        stages = bench(files, trace_memory=not args.no_memory)
+        report.append({'rows': rows, 'stages': stages, 'metrics': metrics.snapshot()})
+        print(f'\nrows={rows}')
+        for stage in stages:
+            peak = f"{stage['peak_mb']:>8.1f} MB" if stage['peak_mb'] is not None else ''
+            print(f"  {stage['stage']:<20} {stage['seconds']:>9.3f}s {peak}")
+        calls = sum(call['calls'] for call in report[-1]['metrics']['api_calls'])
+        sent = sum(call['bytes_sent'] for call in report[-1]['metrics']['api_calls'])
+        print(f"  {'total':<20} {sum(s['seconds'] for s in stages):>9.3f}s  {calls} API calls, {sent / 2 ** 20:.1f} MB sent")
+
+    server.shutdown()
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Synthetic OpenRoad exports with the exact headers DataSet.set_df renames.
+
+    python -m benchmarks.synth_exports --rows 1000 10000 100000 1000000 --out benchmarks/data
+"""
+import argparse
+import os
+from typing import Tuple
+
+import numpy as np
+from openpyxl import Workbook
+
+from utils.ingest import COLUMN_MAP
+
+BROKERS = ['AMAZON LOGISTICS', 'COYOTE LOGISTICS', 'TQL', 'CH ROBINSON', 'ECHO GLOBAL', 'UBER FREIGHT']
+CITIES = [('JOLIET', 'IL', '60436'), ('DALLAS', 'TX', '75201'), ('ATLANTA', 'GA', '30303'),
+          ('RIVERSIDE', 'CA', '92501'), ('COLUMBUS', 'OH', '43215'), ('MEMPHIS', 'TN', '38103')]
+TIMEZONES = ['EST', 'CST', 'MST', 'PST']
+STATUSES = ['Delivered', 'Dispatched', 'In Transit', 'Completed']
+FIRST_NAMES = ['John', 'Azamat', 'Mike', 'Bakyt', 'David', 'Nurlan']
+LAST_NAMES = ['Smith', 'Asanov', 'Brown', 'Tokonov', 'Miller', 'Usenov']
+DRIVERS = 5000
+
+
+def driver_ids(count: int = DRIVERS):
+    return [str(1000 + i) for i in range(count)]
+
+
+def load_number(index: int) -> str:
+    return str(1000000 + index)
+
+
+def generate_export(path: str, rows: int, first_load: int = 0, seed: int = 0):
+    """Пишет одну выгрузку в режиме write_only, строками, без DataFrame в памяти."""
+    rng = np.random.default_rng(seed)
+    drivers = driver_ids()
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Loads')
+    sheet.append(list(COLUMN_MAP))
+
+    block = 10000
+    for offset in range(0, rows, block):
+        size = min(block, rows - offset)
+        broker = rng.integers(0, len(BROKERS), size)
+        pickup = rng.integers(0, len(CITIES), size)
+        delivery = rng.integers(0, len(CITIES), size)
+        driver = rng.integers(0, len(drivers), size)
+        zone = rng.integers(0, len(TIMEZONES), size)
+        day = rng.integers(1, 28, size)
+        start = rng.integers(0, 20, size)
+        linehaul = rng.uniform(300, 6000, size).round(2)
+        empty = rng.integers(0, 200, size)
+        loaded = rng.integers(50, 2500, size)
+        status = rng.integers(0, len(STATUSES), size)
+        for i in range(size):
+            load = load_number(first_load + offset + i)
+            pu_city, pu_state, pu_zip = CITIES[pickup[i]]
+            del_city, del_state, del_zip = CITIES[delivery[i]]
+            driver_id = drivers[driver[i]]
+            name = f'{FIRST_NAMES[driver[i] % len(FIRST_NAMES)]} {LAST_NAMES[driver[i] % len(LAST_NAMES)]}'
+            tz = TIMEZONES[zone[i]]
+            values = {
+                'Company Load#': load,
+                'Contract/Spot': 'Spot',
+                'Fleet manager': 'Fleet',
+                'Sales Rep': 'Sales',
+                'Customer': f'{BROKERS[broker[i]]} {load}',
+                'Position': 'Truck',
+                'Status': STATUSES[status[i]],
+                '# of Picks': 1,
+                'PU Info': f'{pu_city}, {pu_state} {pu_zip}',
+                'PU State Code': pu_state,
+                'PU Time': f'12/{day[i]:02d}/2024 {start[i]:02d}:00 - {start[i] + 4:02d}:00{tz}',
+                'Driver PU Time': None,
+                '# of Drops': 1,
+                'DEL Info': f'{del_city}, {del_state} {del_zip}',
+                'DEL State Code': del_state,
+                'DEL Time': f'12/{day[i] + 1:02d}/2024 {start[i]:02d}:00 - {(start[i] + 8) % 24:02d}:00{tz}',
+                'Driver DEL Time': None,
+                'Driver': f'{driver_id} - {name} (100.0%)',
+                'Linehaul': float(linehaul[i]),
+                'Fuel Surcharge': 0,
+                'Linehaul Total': float(linehaul[i]),
+                'Empty Miles': int(empty[i]),
+                'Loaded Miles': int(loaded[i]),
+                '$ per mile (loaded)': round(float(linehaul[i]) / int(loaded[i]), 2),
+                '$ per mile (total)': round(float(linehaul[i]) / (int(loaded[i]) + int(empty[i])), 2),
+                'Actions': None,
+                'Lumper': 0,
+            }
+            sheet.append([values[column] for column in COLUMN_MAP])
+    workbook.save(path)
+
+
+def generate_pair(folder: str, rows: int, overlap: float = 0.05, seed: int = 0) -> Tuple[str, str]:
+    """Пара выгрузок (kgline, tutash) на rows строк суммарно; overlap доля грузов есть в обеих."""
+    os.makedirs(folder, exist_ok=True)
+    kgline = os.path.join(folder, f'kgline_{rows}.xlsx')
+    tutash = os.path.join(folder, f'tutash_{rows}.xlsx')
+    half = rows // 2
+    shared = int(half * overlap)
+    if not os.path.exists(kgline):
+        generate_export(kgline, half, first_load=0, seed=seed)
+    if not os.path.exists(tutash):
+        generate_export(tutash, rows - half, first_load=half - shared, seed=seed + 1)
+    return kgline, tutash
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--out', default='benchmarks/data')
+    parser.add_argument('--overlap', type=float, default=0.05)
+    args = parser.parse_args()
+    for rows in args.rows:
+        print(rows, *generate_pair(args.out, rows, args.overlap))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,51 +1,77 @@
+import argparse
 import logging
 import os
 import glob
-from utils.job import PickupDelivery, LoadRecord, Trip
-from utils.salesforce_interfrnc import SalesforceAuthentication
+from utils import configure
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Путь для временного сохранения файлов
 UPLOAD_FOLDER = 'temp/'
 SUPPORTIVE_FOLDER = 'set/'
-# Проверяем, существует ли папка, и создаем её при необходимости
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-def process_files():
+def process_files(stages=('trips',), fresh: bool = False):
     try:
+        # Get list of Excel files
+        # По выгрузке на автопарк; при совпадении груза побеждает файл, идущий позже по имени
+        # Сначала выгрузки, потом всё тяжёлое: запуск по расписанию без файлов не логинится и не грузит pandas
+        excel_files = sorted(glob.glob(os.path.join(UPLOAD_FOLDER, "*.xlsx")))
+        if not excel_files:
+            logger.info("No Excel files found for processing.")
+            return
+
+        from utils.pipeline import build_pipeline
+        from utils.salesforce_interfrnc import SalesforceAuthentication
+        from utils.metrics import metrics
+
         # Initialize Salesforce sessions
         auth = SalesforceAuthentication()
         sf_rest_session, sf_bulk_session = auth.get_sessions()
-        
+
         # Check if sessions are valid
         if not sf_rest_session or not sf_bulk_session:
             logger.error('Failed to initialize Salesforce session')
             return
 
-        # Get list of Excel files
-        excel_files = glob.glob(os.path.join(UPLOAD_FOLDER, "*.xlsx"))
-        if not excel_files:
-            logger.info("No Excel files found for processing.")
-            
-        # Create Trip instance (inherits LoadRecord and PickupDelivery functionality)
-        load_instance = LoadRecord(excel_files[0], excel_files[1])
-        pck_del_instance = PickupDelivery(excel_files[0], excel_files[1])
-        
-
-        # Process LoadRecord, PickupDelivery, and Trip data
-        # load_instance.process_file()
-        # pck_del_instance.picup_dlvr_loader()
-        
-        trip_instance = Trip(excel_files[0], excel_files[1], SUPPORTIVE_FOLDER)
-        trip_instance.process_trip_records()
-
-        logger.info(f"File {excel_files} processed successfully")
-        
+        # Одна сессия и один разбор Excel на все стадии Load -> Stop_Position -> Trip
+        # Упавший запуск на тех же выгрузках продолжается по журналу, если не задан --fresh
+        runner = build_pipeline(excel_files, SUPPORTIVE_FOLDER, fresh=fresh)
+        states = runner.run(stages)
+
+        if all(state == 'done' for state in states.values()):
+            logger.info(f"File {excel_files} processed successfully")
+        else:
+            logger.error(f"Pipeline finished with errors: {states}")
+        metrics.write_report()
+
     except Exception as e:
         logger.error(f"Error in process_files: {e}")
-        
+
+
+def parse_args(argv=None):
+    # Модули utils читают окружение при импорте, поэтому импорт после configure()
+    from utils.pipeline import PUBLIC_STAGES
+
+    parser = argparse.ArgumentParser(description='Send OpenRoad exports to Salesforce via Bulk API.')
+    parser.add_argument('--stages', default='trips',
+                        help=f"comma separated stages to run, any of {','.join(PUBLIC_STAGES)} (default: trips)")
+    parser.add_argument('--fresh', action='store_true',
+                        help='ignore the journal of an interrupted run on the same exports and start over')
+    parser.add_argument('--profile', action='store_true',
+                        help='write cProfile and tracemalloc reports of the pipeline stages to set/reports/profiles/')
+    args = parser.parse_args(argv)
+    args.stages = [stage.strip() for stage in args.stages.split(',') if stage.strip()]
+    unknown = set(args.stages) - set(PUBLIC_STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    return args
+
+
 if __name__ == '__main__':
-    process_files()
+    # .env и логирование настраиваются здесь, а не при импорте модулей utils
+    configure()
+    args = parse_args()
+    if args.profile:
+        from utils.profiling import profiler
+        profiler.enable()
+    process_files(args.stages, fresh=args.fresh)
@@ -0,0 +1,252 @@
+import logging
+import os
+import glob
+import queue
+import re
+import shutil
+import threading
+import time
+import uuid
+from typing import Dict, List, Tuple
+
+from flask import Flask, Response, jsonify, request
+
+from utils import configure
+
+# .env и логирование до импорта модулей utils и чтения настроек сервиса
+configure()
+
+from utils.pipeline import build_pipeline  # noqa: E402
+from utils.metrics import metrics  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', 'temp/')
+SUPPORTIVE_FOLDER = 'set/'
+PROCESSED_FOLDER = os.path.join(UPLOAD_FOLDER, 'processed')
+FAILED_FOLDER = os.path.join(UPLOAD_FOLDER, 'failed')
+
+PIPELINE_STAGES = [s.strip() for s in os.getenv('PIPELINE_STAGES', 'trips').split(',') if s.strip()]
+# Сколько выгрузок (по одной на автопарк) составляют один запуск пайплайна
+EXPORTS_PER_JOB = int(os.getenv('EXPORTS_PER_JOB', '2'))
+SERVICE_WORKERS = int(os.getenv('SERVICE_WORKERS', '2'))
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '8'))
+WATCH_INTERVAL = float(os.getenv('WATCH_INTERVAL', '5'))
+# Через сколько секунд выгрузка без пары обрабатывается одна
+PENDING_FLUSH_SECONDS = float(os.getenv('PENDING_FLUSH_SECONDS', '300'))
+# Автопарк выгрузки по имени файла (kgline_1017.xlsx -> kgline): две выгрузки одного автопарка не попадают в одно задание
+EXPORT_FLEET_PATTERN = re.compile(os.getenv('EXPORT_FLEET_PATTERN', r'^[A-Za-z]+'))
+# Всё, кроме этих символов, в имени скачанного файла заменяется на '_'
+UNSAFE_FILENAME_CHARS = re.compile(r'[^A-Za-z0-9._-]+')
+
+
+class IngestionService:
+    """Резидентный сервис: файлы из /receive_file и из UPLOAD_FOLDER собираются в задания
+    по EXPORTS_PER_JOB выгрузок и обрабатываются пулом воркеров с тёплыми сессиями и кэшами."""
+
+    def __init__(self, upload_folder: str = UPLOAD_FOLDER, workers: int = SERVICE_WORKERS,
+                 queue_size: int = JOB_QUEUE_SIZE):
+        self.upload_folder = upload_folder
+        self.jobs: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pending: List[str] = []
+        self._pending_since = 0.0
+        self._claimed = set()
+        self._sizes: Dict[str, Tuple[int, int]] = {}
+        self._stop = threading.Event()
+
+    def start(self):
+        # Логин в Salesforce — при первом задании или загрузке файла, а не при старте сервиса
+        for i in range(self.workers):
+            threading.Thread(target=self.worker, name=f'ingest-worker-{i}', daemon=True).start()
+        threading.Thread(target=self.watch, name='upload-watcher', daemon=True).start()
+        logger.info(f"Ingestion service started: {self.workers} workers, watching {self.upload_folder}")
+
+    def stop(self):
+        self._stop.set()
+
+    @staticmethod
+    def export_fleet(path: str) -> str:
+        name = os.path.basename(path)
+        match = EXPORT_FLEET_PATTERN.search(name)
+        return match.group(0).lower() if match else name
+
+    def add_file(self, path: str):
+        """Регистрирует готовый файл; как только набралось EXPORTS_PER_JOB выгрузок разных автопарков,
+        ставит задание в очередь. Вторая выгрузка того же автопарка отправляет ожидающие файлы без пары."""
+        ready = []
+        with self._lock:
+            path = os.path.abspath(path)
+            if path in self._claimed:
+                return
+            fleet = self.export_fleet(path)
+            if any(self.export_fleet(pending) == fleet for pending in self._pending):
+                logger.warning(f"Another {fleet} export arrived, processing {self.names(self._pending)} without a pair")
+                ready.append(self._pending)
+                self._pending = []
+            self._claimed.add(path)
+            if not self._pending:
+                self._pending_since = time.monotonic()
+            self._pending.append(path)
+            if len(self._pending) >= EXPORTS_PER_JOB:
+                ready.append(self._pending)
+                self._pending = []
+            else:
+                logger.info(f"Waiting for {EXPORTS_PER_JOB - len(self._pending)} more exports, "
+                            f"pending {self.names(self._pending)}")
+        self.enqueue(ready)
+
+    def flush_pending(self):
+        """Ставит в очередь выгрузки, которые ждут пару дольше PENDING_FLUSH_SECONDS."""
+        with self._lock:
+            if not self._pending or time.monotonic() - self._pending_since < PENDING_FLUSH_SECONDS:
+                return
+            files, self._pending = self._pending, []
+        logger.warning(f"No matching export within {PENDING_FLUSH_SECONDS:.0f}s, processing {self.names(files)} alone")
+        self.enqueue([files])
+
+    def enqueue(self, jobs: List[List[str]]):
+        for position, files in enumerate(jobs):
+            try:
+                self.jobs.put_nowait(files)
+                logger.info(f"Queued job for {files} ({self.jobs.qsize()} waiting)")
+            except queue.Full:
+                # Возвращаем файлы: watcher подхватит их снова, когда в очереди освободится место
+                with self._lock:
+                    for rest in jobs[position:]:
+                        self._claimed.difference_update(rest)
+                raise
+
+    @staticmethod
+    def names(files: List[str]) -> List[str]:
+        return [os.path.basename(path) for path in files]
+
+    def watch(self):
+        """Опрашивает UPLOAD_FOLDER; файл считается готовым, когда его размер и mtime не меняются между опросами."""
+        while not self._stop.is_set():
+            try:
+                for path in sorted(glob.glob(os.path.join(self.upload_folder, '*.xlsx'))):
+                    path = os.path.abspath(path)
+                    stat = os.stat(path)
+                    signature = (stat.st_size, stat.st_mtime_ns)
+                    if self._sizes.get(path) == signature and path not in self._claimed:
+                        self.add_file(path)
+                    self._sizes[path] = signature
+                self.flush_pending()
+            except queue.Full:
+                logger.warning("Job queue is full, new exports will wait")
+            except Exception as e:
+                logger.error(f"Upload watcher error: {e}")
+            self._stop.wait(WATCH_INTERVAL)
+
+    def worker(self):
+        while not self._stop.is_set():
+            try:
+                # С таймаутом, чтобы stop() завершал и простаивающих воркеров
+                files = self.jobs.get(timeout=WATCH_INTERVAL)
+            except queue.Empty:
+                continue
+            job_id = uuid.uuid4().hex[:8]
+            job_folder = os.path.join(self.upload_folder, 'processing', job_id)
+            os.makedirs(job_folder, exist_ok=True)
+            moved = []
+            try:
+                # Переносим файлы, чтобы watcher не подхватил их повторно
+                for path in sorted(files):
+                    target = os.path.join(job_folder, os.path.basename(path))
+                    os.replace(path, target)
+                    moved.append(target)
+                with self._lock:
+                    self._claimed.difference_update(files)
+                started = time.monotonic()
+                # Первое задание логинится, следующие переиспользуют общие сессии
+                from utils.salesforce_interfrnc import SalesforceAuthentication
+                sf, bulk = SalesforceAuthentication.get_sessions()
+                if not sf or not bulk:
+                    raise RuntimeError('Failed to initialize Salesforce session')
+                states = build_pipeline(moved, SUPPORTIVE_FOLDER).run(PIPELINE_STAGES)
+                ok = all(state == 'done' for state in states.values())
+                logger.info(f"Job {job_id} finished in {time.monotonic() - started:.1f}s: {states}")
+                # Отчёт накопительный: счётчики с момента запуска сервиса
+                metrics.write_report()
+            except Exception as e:
+                ok = False
+                logger.error(f"Job {job_id} failed: {e}")
+            finally:
+                destination = os.path.join(PROCESSED_FOLDER if ok else FAILED_FOLDER, job_id)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                shutil.move(job_folder, destination)
+                self.jobs.task_done()
+
+    @staticmethod
+    def download_filename(version: dict, content_document_id: str) -> str:
+        """Имя файла из Title и расширения ContentVersion без разделителей пути: '../../x' не выйдет из UPLOAD_FOLDER."""
+        title = UNSAFE_FILENAME_CHARS.sub('_', os.path.basename(str(version.get('Title') or ''))).strip('._')
+        extension = UNSAFE_FILENAME_CHARS.sub('', str(version.get('FileExtension') or '')).strip('.') or 'xlsx'
+        return f"{title or 'export'}_{content_document_id}.{extension}"
+
+    def download_content_document(self, content_document_id: str) -> str:
+        """Скачивает последнюю версию файла Salesforce Files в UPLOAD_FOLDER."""
+        from utils.salesforce_interfrnc import SalesforceAuthentication
+
+        sf, _ = SalesforceAuthentication.get_sessions()
+        if not sf:
+            raise RuntimeError('Salesforce REST session not initialized')
+        result = sf.query(
+            "SELECT Id, Title, FileExtension, VersionData FROM ContentVersion "
+            f"WHERE ContentDocumentId = '{content_document_id}' AND IsLatest = true"
+        )
+        if not result['records']:
+            raise FileNotFoundError(f"ContentDocument {content_document_id} not found")
+        version = result['records'][0]
+        url = f"https://{sf.sf_instance}{version['VersionData']}"
+        response = sf.session.get(url, headers={'Authorization': f'Bearer {sf.session_id}'}, stream=True)
+        response.raise_for_status()
+
+        os.makedirs(self.upload_folder, exist_ok=True)
+        path = os.path.join(self.upload_folder, self.download_filename(version, content_document_id))
+        # Пишем во временный файл, чтобы watcher не увидел недокачанный xlsx
+        with open(f'{path}.part', 'wb') as f:
+            for block in response.iter_content(chunk_size=1024 * 1024):
+                f.write(block)
+        os.replace(f'{path}.part', path)
+        logger.info(f"ContentDocument {content_document_id} saved to {path}")
+        return path
+
+
+def create_app(service: IngestionService) -> Flask:
+    app = Flask(__name__)
+
+    @app.route('/receive_file', methods=['POST'])
+    def receive_file():
+        payload = request.get_json(silent=True) or {}
+        content_document_id = payload.get('ContentDocumentId')
+        if not content_document_id or not str(content_document_id).isalnum():
+            return jsonify({'error': 'ContentDocumentId is required'}), 400
+        try:
+            path = service.download_content_document(content_document_id)
+            service.add_file(path)
+        except FileNotFoundError as e:
+            return jsonify({'error': str(e)}), 404
+        except queue.Full:
+            return jsonify({'error': 'Job queue is full, retry later'}), 503
+        except Exception as e:
+            logger.error(f"Error in receive_file: {e}")
+            return jsonify({'error': 'Failed to receive file'}), 500
+        return jsonify({'status': 'accepted', 'file': os.path.basename(path)}), 202
+
+    @app.route('/metrics', methods=['GET'])
+    def prometheus_metrics():
+        text = metrics.prometheus_text()
+        text += '# TYPE adv_load_recorder_job_queue_depth gauge\n'
+        text += f'adv_load_recorder_job_queue_depth {service.jobs.qsize()}\n'
+        return Response(text, mimetype='text/plain; version=0.0.4')
+
+    return app
+
+
+if __name__ == '__main__':
+    ingestion = IngestionService()
+    ingestion.start()
+    create_app(ingestion).run(host=os.getenv('SERVICE_HOST', '127.0.0.1'), port=int(os.getenv('SERVICE_PORT', '5000')))
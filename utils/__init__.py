@@ -0,0 +1,46 @@
+"""Пакет пайплайна OpenRoad -> Salesforce.
+
+Модули с pandas, simple_salesforce и salesforce_bulk импортируются только при первом обращении
+к их именам (PEP 562), поэтому `import utils` и точки входа без работы не платят за их загрузку.
+"""
+import importlib
+import logging
+
+# Публичное имя -> модуль, из которого оно загружается при первом обращении.
+# metrics сюда не входит: имя совпадает с подмодулем utils.metrics
+_LAZY_NAMES = {
+    'DataSet': 'utils.job',
+    'LoadRecord': 'utils.job',
+    'PickupDelivery': 'utils.job',
+    'Trip': 'utils.job',
+    'build_pipeline': 'utils.pipeline',
+    'PUBLIC_STAGES': 'utils.pipeline',
+    'SalesforceAuthentication': 'utils.salesforce_interfrnc',
+    'profiler': 'utils.profiling',
+}
+
+__all__ = ['configure', *_LAZY_NAMES]
+
+
+def configure(level: int = logging.INFO):
+    """Переменные из .env и логирование; вызывается точкой входа до обращения к модулям пакета.
+
+    Модули читают настройки из окружения при импорте, поэтому .env загружается раньше них.
+    """
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=level, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def __getattr__(name: str):
+    module = _LAZY_NAMES.get(name)
+    if module is None:
+        raise AttributeError(f"module 'utils' has no attribute '{name}'")
+    value = getattr(importlib.import_module(module), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_NAMES))
@@ -0,0 +1,242 @@
+"""Офлайн индекс город/штат -> ZIP и разбор адресов из PU Info / DEL Info.
+
+Индекс собирается один раз из почтового дампа GeoNames (US.txt, https://download.geonames.org/export/zip/):
+
+    python -m utils.address_index US.txt --out set/address_index.bin
+"""
+import argparse
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+from typing import Dict, List, NamedTuple, Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+ADDRESS_INDEX_PATH = os.getenv('ADDRESS_INDEX_PATH', 'set/address_index.bin')
+ADDRESS_MEMO_PATH = os.getenv('ADDRESS_MEMO_PATH', 'set/address_memo.json')
+
+INDEX_MAGIC = b'ADRIDX01'
+# Заголовок: magic, число записей; запись: ключ 'ST|CITY' с пробелами до KEY_WIDTH байт и ZIP
+HEADER = struct.Struct('<8sI')
+KEY_WIDTH = 40
+ZIP_WIDTH = 5
+RECORD_WIDTH = KEY_WIDTH + ZIP_WIDTH
+
+# "123 MAIN ST, JOLIET, IL 60436-1234", "JOLIET, IL 60436", "JOLIET, IL"
+ADDRESS_PATTERN = re.compile(
+    r'^(?:(?P<head>.*),\s*)?(?P<city>[^,]+?)\s*,?\s+(?P<state>[A-Za-z]{2})\.?(?:\s+(?P<zip>\d{5})(?:-?\d{4})?)?$'
+)
+STREET_PATTERN = re.compile(r'^\d+[A-Za-z]?\s+\S')
+# Штаты, округ Колумбия и территории; иначе "123 MAIN ST" без штата разобрался бы как город "123 MAIN", штат "ST"
+US_STATE_CODES = frozenset('''
+    AL AK AZ AR CA CO CT DE DC FL GA HI ID IL IN IA KS KY LA ME MD MA MI MN MS MO MT NE NV NH NJ NM NY NC ND
+    OH OK OR PA RI SC SD TN TX UT VT VA WA WV WI WY AS GU MP PR VI
+'''.split())
+
+
+class Address(NamedTuple):
+    street: str
+    city: str
+    state: str
+    zip: str
+
+
+def index_key(state: str, city: str) -> bytes:
+    key = f'{state.strip().upper()}|{" ".join(city.upper().split())}'.encode('ascii', 'ignore')[:KEY_WIDTH]
+    return key.ljust(KEY_WIDTH)
+
+
+def build_address_index(places: pd.DataFrame, index_path: str = ADDRESS_INDEX_PATH) -> int:
+    """Пишет отсортированные записи (state, city) -> zip; у города с несколькими ZIP берётся наименьший."""
+    places = places[['state', 'city', 'zip']].dropna().astype(str)
+    places = places[places['zip'].str.fullmatch(r'\d{5}')]
+    records = {}
+    for state, city, zip_code in places.itertuples(index=False, name=None):
+        key = index_key(state, city)
+        if key not in records or zip_code < records[key]:
+            records[key] = zip_code
+    os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(INDEX_MAGIC, len(records)))
+        for key in sorted(records):
+            f.write(key + records[key].encode('ascii'))
+    os.replace(tmp_path, index_path)
+    logger.info(f"Address index {index_path} built with {len(records)} cities")
+    return len(records)
+
+
+def index_version(index_path: str = ADDRESS_INDEX_PATH) -> str:
+    """Размер и mtime файла индекса; пустая строка, если индекса нет."""
+    try:
+        stat = os.stat(index_path)
+    except OSError:
+        return ''
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def read_geonames(path: str) -> pd.DataFrame:
+    """Почтовый дамп GeoNames: country, postal code, place name, admin name1, admin code1, ..."""
+    raw = pd.read_csv(path, sep='\t', header=None, usecols=[1, 2, 4], dtype=str, keep_default_na=False)
+    return raw.rename(columns={1: 'zip', 2: 'city', 4: 'state'})
+
+
+class AddressIndex:
+    """Индекс в памяти процесса через mmap: файл не читается целиком, поиск — бинарный по записям."""
+
+    def __init__(self, index_path: str = ADDRESS_INDEX_PATH):
+        self.index_path = index_path
+        self._file = open(index_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self._map, 0)
+        if magic != INDEX_MAGIC or len(self._map) != HEADER.size + self.count * RECORD_WIDTH:
+            self.close()
+            raise ValueError(f"{index_path} is not an address index")
+
+    @property
+    def version(self) -> str:
+        return index_version(self.index_path)
+
+    def _key_at(self, position: int) -> bytes:
+        offset = HEADER.size + position * RECORD_WIDTH
+        return self._map[offset:offset + KEY_WIDTH]
+
+    def lookup_zip(self, state: str, city: str) -> Optional[str]:
+        key = index_key(state, city)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._key_at(low) == key:
+            offset = HEADER.size + low * RECORD_WIDTH + KEY_WIDTH
+            return self._map[offset:offset + ZIP_WIDTH].decode('ascii')
+        return None
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def parse_address(info: str, state_code: str = '') -> Address:
+    """Разбирает строку OpenRoad; улица — сегмент перед городом, начинающийся с номера дома."""
+    text = ' '.join(str(info).split())
+    match = ADDRESS_PATTERN.match(text)
+    if not match or match['state'].upper() not in US_STATE_CODES:
+        return Address('', text.split(',', 1)[0].strip(), state_code, '')
+    street = ''
+    for segment in reversed((match['head'] or '').split(',')):
+        if STREET_PATTERN.match(segment.strip()):
+            street = segment.strip()
+            break
+    return Address(street, match['city'], match['state'].upper(), match['zip'] or '')
+
+
+class AddressResolver:
+    """Разбирает каждую различную строку адреса один раз; результаты сохраняются между запусками.
+
+    ZIP берётся из самой строки, а если его нет — из индекса по городу и штату.
+    Memo сбрасывается, если индекс пересобран.
+    """
+
+    def __init__(self, index_path: str = ADDRESS_INDEX_PATH, memo_path: str = ADDRESS_MEMO_PATH):
+        self.memo_path = memo_path
+        self.index: Optional[AddressIndex] = None
+        if os.path.exists(index_path):
+            try:
+                self.index = AddressIndex(index_path)
+            except Exception as e:
+                logger.warning(f"Address index {index_path} is unreadable, ZIPs come from the exports only: {e}")
+        else:
+            logger.info(f"Address index {index_path} not found, ZIPs come from the exports only")
+        self.index_version = self.index.version if self.index else ''
+        self.memo: Dict[str, List[str]] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.load_memo()
+
+    def load_memo(self):
+        if not os.path.exists(self.memo_path):
+            return
+        try:
+            with open(self.memo_path, encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get('index_version') == self.index_version:
+                self.memo = cached['addresses']
+        except Exception as e:
+            logger.warning(f"Address memo {self.memo_path} is unreadable, ignoring it: {e}")
+
+    def save_memo(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.memo_path) or '.', exist_ok=True)
+            tmp_path = f'{self.memo_path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'index_version': self.index_version, 'addresses': self.memo}, f)
+            os.replace(tmp_path, self.memo_path)
+            self._dirty = False
+
+    def resolve(self, info: str, state_code: str = '') -> Address:
+        key = f'{state_code}|{info}'
+        cached = self.memo.get(key)
+        if cached is not None:
+            return Address(*cached)
+        address = parse_address(info, state_code) if info else Address('', '', state_code, '')
+        if not address.zip and address.city and address.state and self.index is not None:
+            address = address._replace(zip=self.index.lookup_zip(address.state, address.city) or '')
+        with self._lock:
+            self.memo[key] = list(address)
+            self._dirty = True
+        return address
+
+    def add_address_columns(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Добавляет {pu,del}_street/_city/_zip; разбирается каждая различная пара (адрес, штат), а не строка."""
+        resolved = 0
+        for prefix in ('pu', 'del'):
+            info = df[f'{prefix}_info'].astype('string').fillna('')
+            state = df[f'{prefix}_state_code'].astype('string').fillna('')
+            codes, pairs = pd.factorize(pd.MultiIndex.from_arrays([info, state]))
+            addresses = pd.DataFrame([self.resolve(text, code) for text, code in pairs],
+                                     columns=list(Address._fields))
+            resolved += len(addresses)
+            for field in ('street', 'city', 'zip'):
+                df[f'{prefix}_{field}'] = addresses[field].to_numpy()[codes]
+        missing = sum(int(df[f'{prefix}_zip'].eq('').sum()) for prefix in ('pu', 'del'))
+        logger.info(f"Resolved {resolved} distinct addresses for {len(df)} rows, {missing} stops without ZIP")
+        self.save_memo()
+        return df
+
+
+_resolver: Optional[AddressResolver] = None
+_resolver_lock = threading.Lock()
+
+
+def shared_resolver() -> AddressResolver:
+    """Один индекс и memo на процесс: в сервисе mmap открывается один раз."""
+    global _resolver
+    with _resolver_lock:
+        if _resolver is None:
+            _resolver = AddressResolver()
+        return _resolver
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the offline city/state -> ZIP index from a GeoNames postal dump.')
+    parser.add_argument('source', help='GeoNames US.txt')
+    parser.add_argument('--out', default=ADDRESS_INDEX_PATH)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    build_address_index(read_geonames(args.source), args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import logging
+import tempfile
+from typing import Iterable, Iterator, List, Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Батч держим в памяти до этого размера, дальше SpooledTemporaryFile уходит на диск
+SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+class CsvBatch:
+    """Один CSV батч Bulk API: файл с заголовком и строками payload[start:start + records]."""
+
+    def __init__(self, file, start: int):
+        self.file = file
+        self.start = start
+        self.records = 0
+        self.size = 0
+
+    def rewind(self):
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+
+class CsvBatchWriter:
+    """Потоково сериализует DataFrame payload в CSV батчи в пределах лимитов по записям и байтам.
+
+    Каждый кусок DataFrame пишется одним вызовом DataFrame.to_csv, поэтому в памяти одновременно
+    находится только текущий кусок и не больше SPOOL_MAX_MEMORY байт батча. Кусок, который не
+    помещается в батч по байтам, уменьшается, пока граница батча не окажется между строками.
+    """
+
+    def __init__(self, max_records: int, max_bytes: int, rows_per_slice: int = 1000):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.rows_per_slice = rows_per_slice
+
+    @staticmethod
+    def _encode(part: pd.DataFrame, header: bool = False) -> bytes:
+        # Значения через str(), как у csv.writer: даты и числа в object колонках не переформатируются
+        part = part.astype(object)
+        part = part.where(part.notna(), '')
+        return part.to_csv(index=False, header=header, lineterminator='\n').encode('utf-8')
+
+    def _open(self, header: bytes, start: int) -> CsvBatch:
+        batch = CsvBatch(tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY, mode='w+b'), start)
+        batch.file.write(header)
+        batch.size = len(header)
+        return batch
+
+    def iter_batches(self, frames: Iterable[pd.DataFrame]) -> Iterator[CsvBatch]:
+        """Отдаёт заполненные батчи по мере записи; вызывающий закрывает каждый файл."""
+        columns: Optional[List[str]] = None
+        header = b''
+        current: Optional[CsvBatch] = None
+        offset = 0
+        for frame in frames:
+            if frame is None or frame.empty:
+                continue
+            if columns is None:
+                columns = list(frame.columns)
+                header = self._encode(frame.iloc[:0], header=True)
+            elif list(frame.columns) != columns:
+                frame = frame.reindex(columns=columns)
+
+            position = 0
+            while position < len(frame):
+                if current is not None and current.records >= self.max_records:
+                    yield current
+                    current = None
+                if current is None:
+                    current = self._open(header, offset)
+                # Кусок не больше rows_per_slice и не больше свободного места батча по записям
+                rows = min(self.rows_per_slice, self.max_records - current.records, len(frame) - position)
+                data = self._encode(frame.iloc[position:position + rows])
+                while current.size + len(data) > self.max_bytes and rows > 1:
+                    # Уменьшаем кусок пропорционально свободным байтам, но хотя бы вдвое
+                    free = max(self.max_bytes - current.size, 0)
+                    rows = max(1, min(rows // 2, rows * free // len(data)))
+                    data = self._encode(frame.iloc[position:position + rows])
+                if current.size + len(data) > self.max_bytes and current.records:
+                    # Даже одна строка не помещается: закрываем батч, строка пойдёт в следующий
+                    yield current
+                    current = None
+                    continue
+                current.file.write(data)
+                current.records += rows
+                current.size += len(data)
+                position += rows
+                offset += rows
+        if current is not None:
+            yield current
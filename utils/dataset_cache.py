@@ -0,0 +1,122 @@
+import logging
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional, Sequence
+
+import pandas as pd
+
+from utils.address_index import index_version
+from utils.schema import apply_schema
+
+logger = logging.getLogger(__name__)
+
+# Меняем версию при изменении логики DataSet.set_df, чтобы старый кэш не использовался
+CACHE_SCHEMA_VERSION = 4
+CACHE_FOLDER = os.getenv('DATASET_CACHE_FOLDER', 'set/cache/')
+# Сколько разобранных наборов держать в памяти; в сервисе набор нужен только стадиям одного задания,
+# старые вытесняются (LRU) и при необходимости читаются из parquet. 0 — только диск
+CACHE_MEMORY_ENTRIES = int(os.getenv('DATASET_CACHE_MEMORY_ENTRIES', '2'))
+
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+
+class ParsedDatasetCache:
+    """Кэш нормализованных DataFrame в памяти и в parquet на диске.
+
+    Ключ строится по хэшу содержимого и mtime всех входных файлов, поэтому
+    повторный запуск на неизменённых выгрузках не вызывает openpyxl.
+    В памяти хранятся только max_entries последних наборов.
+    """
+
+    def __init__(self, cache_folder: str = CACHE_FOLDER, max_entries: int = CACHE_MEMORY_ENTRIES):
+        self.cache_folder = cache_folder
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, pd.DataFrame]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def file_fingerprint(filepath: str) -> str:
+        """Returns a sha256 digest of the file content combined with its mtime."""
+        digest = hashlib.sha256()
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        digest.update(str(os.stat(filepath).st_mtime_ns).encode())
+        return digest.hexdigest()
+
+    def make_key(self, filepaths: Sequence[str]) -> str:
+        digest = hashlib.sha256(f'v{CACHE_SCHEMA_VERSION}'.encode())
+        # ZIP и улицы стопов берутся из индекса адресов: пересобранный индекс даёт новый ключ
+        digest.update(index_version().encode())
+        for filepath in filepaths:
+            digest.update(self.file_fingerprint(filepath).encode())
+        return digest.hexdigest()[:32]
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.cache_folder, f'{key}.parquet')
+
+    def _read_disk(self, key: str) -> Optional[pd.DataFrame]:
+        path = self._disk_path(key)
+        if not PARQUET_AVAILABLE or not os.path.exists(path):
+            return None
+        try:
+            # Parquet не сохраняет dtype категорий, без apply_schema тёплый кадр отличался бы от холодного
+            return apply_schema(pd.read_parquet(path))
+        except Exception as e:
+            logger.warning(f"Failed to read dataset cache {path}: {e}")
+            return None
+
+    def _write_disk(self, key: str, df: pd.DataFrame):
+        if not PARQUET_AVAILABLE:
+            logger.debug("pyarrow is not installed, dataset cache is kept in memory only")
+            return
+        try:
+            os.makedirs(self.cache_folder, exist_ok=True)
+            path = self._disk_path(key)
+            tmp_path = f'{path}.tmp'
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+            logger.info(f"Parsed dataset cached to {path}")
+        except Exception as e:
+            logger.warning(f"Failed to write dataset cache: {e}")
+
+    def get_or_build(self, filepaths: Sequence[str], builder: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """Возвращает копию кэшированного DataFrame или строит его через builder."""
+        key = self.make_key(filepaths)
+        with self._lock:
+            df = self._memory.get(key)
+            if df is None:
+                df = self._read_disk(key)
+                if df is not None:
+                    logger.info(f"Loaded parsed dataset from disk cache for {list(filepaths)}")
+                else:
+                    df = builder().reset_index(drop=True)
+                    self._write_disk(key, df)
+                self._remember(key, df)
+            else:
+                self._memory.move_to_end(key)
+                logger.info(f"Using in-memory parsed dataset for {list(filepaths)}")
+        # Каждый потребитель получает свою копию, чтобы не портить кэш
+        return df.copy()
+
+    def _remember(self, key: str, df: pd.DataFrame):
+        """Вызывается под self._lock; вытесняет наборы, к которым дольше всего не обращались."""
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = df
+        while len(self._memory) > self.max_entries:
+            evicted, _ = self._memory.popitem(last=False)
+            logger.debug(f"Parsed dataset {evicted} evicted from memory cache")
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+
+dataset_cache = ParsedDatasetCache()
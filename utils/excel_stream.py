@@ -0,0 +1,50 @@
+import logging
+from typing import Iterator, Optional, Sequence
+
+import pandas as pd
+from openpyxl import load_workbook
+
+logger = logging.getLogger(__name__)
+
+
+def iter_excel_chunks(filepath: str, chunk_size: int = 50000,
+                      usecols: Optional[Sequence[str]] = None) -> Iterator[pd.DataFrame]:
+    """Читает первый лист через read-only итератор openpyxl и отдаёт DataFrame по chunk_size строк.
+
+    Если задан usecols, в память попадают только эти колонки, остальные ячейки
+    отбрасываются сразу при чтении строки.
+    """
+    workbook = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            logger.warning(f"Empty workbook: {filepath}")
+            return
+
+        columns = [str(name) if name is not None else f'Unnamed: {i}' for i, name in enumerate(header)]
+        if usecols is not None:
+            wanted = set(usecols)
+            positions = [i for i, name in enumerate(columns) if name in wanted]
+        else:
+            positions = list(range(len(columns)))
+        selected = [columns[i] for i in positions]
+
+        buffer = []
+        total = 0
+        for row in rows:
+            values = [row[i] if i < len(row) else None for i in positions]
+            # read-only режим отдаёт хвостовые пустые строки листа
+            if all(value is None for value in values):
+                continue
+            buffer.append(values)
+            if len(buffer) >= chunk_size:
+                total += len(buffer)
+                yield pd.DataFrame(buffer, columns=selected)
+                buffer = []
+        if buffer:
+            total += len(buffer)
+            yield pd.DataFrame(buffer, columns=selected)
+        logger.info(f"Streamed {total} rows from {filepath}")
+    finally:
+        workbook.close()
@@ -0,0 +1,105 @@
+import logging
+from typing import Any, Dict, Union
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class const:
+    """Constant value for every row of the sObject payload."""
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __call__(self, df: pd.DataFrame) -> pd.Series:
+        return pd.Series(self.value, index=df.index, dtype=object)
+
+
+class as_float:
+    """Numeric column; values that cannot be parsed are sent empty."""
+
+    def __init__(self, column: str):
+        self.column = column
+
+    def __call__(self, df: pd.DataFrame) -> pd.Series:
+        values = pd.to_numeric(df[self.column], errors='coerce')
+        invalid = values.isna() & df[self.column].notna()
+        if invalid.any():
+            logger.error(f"{int(invalid.sum())} values in '{self.column}' are not numeric, e.g. {df.loc[invalid, self.column].iloc[0]!r}")
+        return values
+
+
+class as_sf_datetime:
+    """UTC datetime column formatted for Salesforce."""
+
+    def __init__(self, column: str):
+        self.column = column
+
+    def __call__(self, df: pd.DataFrame) -> pd.Series:
+        return df[self.column].dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+# Значение маппинга: имя колонки DataSet.df или функция от DataFrame
+FieldSpec = Union[str, const, as_float, as_sf_datetime]
+
+
+def project_fields(df: pd.DataFrame, field_map: Dict[str, FieldSpec]) -> pd.DataFrame:
+    """Проецирует DataFrame в колонки sObject по маппингу, без построчных dict."""
+    columns = {}
+    for field, spec in field_map.items():
+        columns[field] = df[spec] if isinstance(spec, str) else spec(df)
+    return pd.DataFrame(columns, index=df.index)
+
+
+LOAD_FIELD_MAP: Dict[str, FieldSpec] = {
+    'Name': 'load',
+    'Load_Number__c': 'load',
+    # 'Broker__c': '',
+    'LINEHAUL_RATE__c': as_float('linehaul_total'),
+    'EQUIPMENT_TYPE__c': const('DRY VAN'),
+    'NOTES__c': 'driver',
+    'STATUS__c': 'status',
+    'IsHistory__c': const('true'),
+}
+
+PICKUP_FIELD_MAP: Dict[str, FieldSpec] = {
+    'LOAD__r.Load_Number__c': 'load',
+    'Name': 'pu_info',
+    'TYPE__c': const('Pickup'),
+    'APPOITMENT_START__c': as_sf_datetime('pu_start'),
+    'APPOITMENT_END__c': as_sf_datetime('pu_end'),
+    'LOCATION__City__s': 'pu_city',
+    'LOCATION__CountryCode__s': const('US'),
+    'LOCATION__PostalCode__s': 'pu_zip',
+    'LOCATION__StateCode__s': 'pu_state_code',
+    'LOCATION__Street__s': 'pu_street',
+}
+
+DELIVERY_FIELD_MAP: Dict[str, FieldSpec] = {
+    'LOAD__r.Load_Number__c': 'load',
+    'Name': 'del_info',
+    'TYPE__c': const('Delivery'),
+    'APPOITMENT_START__c': as_sf_datetime('del_start'),
+    'APPOITMENT_END__c': as_sf_datetime('del_end'),
+    'LOCATION__City__s': 'del_city',
+    'LOCATION__CountryCode__s': const('US'),
+    'LOCATION__PostalCode__s': 'del_zip',
+    'LOCATION__StateCode__s': 'del_state_code',
+    'LOCATION__Street__s': 'del_street',
+}
+
+TRIP_FIELD_MAP: Dict[str, FieldSpec] = {
+    'AccountId__r.DRIVER_ID__c': 'driver_id',
+    'LOAD__r.LOAD_NUMBER__c': 'load',
+    'DEL__c': 'delivery_id',
+    'DRIVER_PAY__c': as_float('linehaul_total'),
+    'DV__c': 'vehicle_id',  # поменяем sql из данных будем брат
+    'EMPTY_MI__c': 'empty_miles',
+    'LOADED_MI__c': 'loaded_miles',
+    'PICK__c': 'pickup_id',
+    'PICKUP__c': 'pu_info',
+    'DELIVERY__c': 'del_info',
+    'TRAILER__c': 'unit_id',  # поменяем sql из данных будем брать
+    'TRIP_STATUS__c': 'status',
+}
@@ -0,0 +1,67 @@
+import logging
+from typing import List
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+STOP_COLUMNS = ['load', 'pickup_id', 'delivery_id']
+VEHICLE_COLUMNS = ['driver_id', 'vehicle_type', 'unit_id', 'vehicle_id']
+
+
+def subquery_records(value) -> List[dict]:
+    """Возвращает записи вложенного подзапроса (Stop_Positions__r, Vehicle_History__r) или пустой список."""
+    if isinstance(value, dict):
+        return value.get('records') or []
+    return []
+
+
+def first_id(records: List[dict], field: str, expected: str, value_field: str = 'Id'):
+    for record in records:
+        if record.get(field) == expected:
+            return record.get(value_field)
+    return None
+
+
+def flatten_stop_positions(records: List[dict]) -> pd.DataFrame:
+    """Load__c с подзапросом Stop_Positions__r -> колонки load, pickup_id, delivery_id."""
+    rows = []
+    for record in records:
+        stops = subquery_records(record.get('Stop_Positions__r'))
+        rows.append((
+            record.get('Load_Number__c'),
+            first_id(stops, 'TYPE__c', 'Pickup'),
+            first_id(stops, 'TYPE__c', 'Delivery'),
+        ))
+    return pd.DataFrame(rows, columns=STOP_COLUMNS)
+
+
+def flatten_vehicle_history(records: List[dict]) -> pd.DataFrame:
+    """Account водителя с подзапросом Vehicle_History__r -> driver_id, vehicle_type, unit_id, vehicle_id.
+
+    vehicle_type берётся из первой открытой записи истории, unit_id — UNIT__c
+    первого TRAILER, vehicle_id — Id первой записи TRUCK.
+    """
+    rows = []
+    for record in records:
+        history = subquery_records(record.get('Vehicle_History__r'))
+        rows.append((
+            record.get('DRIVER_ID__c'),
+            history[0].get('TYPE__c') if history else None,
+            first_id(history, 'TYPE__c', 'TRAILER', value_field='UNIT__c'),
+            first_id(history, 'TYPE__c', 'TRUCK'),
+        ))
+    return pd.DataFrame(rows, columns=VEHICLE_COLUMNS)
+
+
+def pivot_stop_rows(frame: pd.DataFrame) -> pd.DataFrame:
+    """Строки Stop_Position__c из Bulk query (Id, TYPE__c, LOAD__r.Load_Number__c) -> load, pickup_id, delivery_id."""
+    frame = frame.rename(columns={'LOAD__r.Load_Number__c': 'load'})
+    pickups = frame[frame['TYPE__c'] == 'Pickup'].drop_duplicates('load').set_index('load')['Id']
+    deliveries = frame[frame['TYPE__c'] == 'Delivery'].drop_duplicates('load').set_index('load')['Id']
+    loads = frame['load'].drop_duplicates()
+    return pd.DataFrame({
+        'load': loads.to_numpy(),
+        'pickup_id': loads.map(pickups).to_numpy(),
+        'delivery_id': loads.map(deliveries).to_numpy(),
+    }, columns=STOP_COLUMNS)
@@ -0,0 +1,143 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Optional, Sequence
+
+import pandas as pd
+
+from utils.excel_stream import iter_excel_chunks
+from utils.normalize import normalize_columns, add_appointment_columns
+from utils.schema import STRING_DTYPE, apply_schema, concat_frames
+
+logger = logging.getLogger(__name__)
+
+# Колонки выгрузки OpenRoad и их внутренние имена
+COLUMN_MAP = {
+    "Company Load#": "company_load_number",
+    "Contract/Spot": "contract_or_spot",
+    "Fleet manager": "fleet_manager",
+    "Sales Rep": "sales_rep",
+    "Customer": "customer",
+    "Position": "position",
+    "Status": "status",
+    "# of Picks": "number_of_picks",
+    "PU Info": "pu_info",
+    "PU State Code": "pu_state_code",
+    "PU Time": "pu_time",
+    "Driver PU Time": "driver_pickup_time",
+    "# of Drops": "number_of_drops",
+    "DEL Info": "del_info",
+    "DEL State Code": "del_state_code",
+    "DEL Time": "del_time",
+    "Driver DEL Time": "driver_delivery_time",
+    "Driver": "driver",
+    "Linehaul": "linehaul",
+    "Fuel Surcharge": "fuel_surcharge",
+    "Linehaul Total": "linehaul_total",
+    "Empty Miles": "empty_miles",
+    "Loaded Miles": "loaded_miles",
+    "$ per mile (loaded)": "dollar_per_mile_loaded",
+    "$ per mile (total)": "dollar_per_mile_total",
+    "Actions": "actions",
+    "Lumper": "lumper"
+}
+
+REQUIRED_COLUMNS = [
+    'customer', 'status', 'pu_info', 'pu_state_code', 'pu_time',
+    'del_info', 'del_state_code', 'del_time', 'driver',
+    'linehaul_total', 'lumper', 'empty_miles', 'loaded_miles'
+]
+
+# Исходные заголовки, которые нужны normalize_export (для потокового чтения)
+SOURCE_COLUMNS = [source for source, target in COLUMN_MAP.items() if target in REQUIRED_COLUMNS]
+
+# Процессов на разбор выгрузок; 1 — разбирать в текущем процессе
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', str(os.cpu_count() or 1)))
+# spawn безопасен в многопоточном сервисе, fork быстрее стартует в одноразовом запуске
+INGEST_START_METHOD = os.getenv('INGEST_START_METHOD', 'spawn')
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def normalize_export(df: pd.DataFrame) -> pd.DataFrame:
+    """Переименовывает колонки OpenRoad, оставляет нужные, нормализует и назначает dtype."""
+    df = df.rename(columns=COLUMN_MAP, errors='ignore')
+    df = df[[col for col in REQUIRED_COLUMNS if col in df.columns]].copy()
+    df = normalize_columns(df)
+    df = add_appointment_columns(df)
+    # dtype назначаются один раз здесь и дальше сохраняются в concat, кэше и merge
+    return apply_schema(df)
+
+
+def source_column(source: str, length: int) -> pd.Categorical:
+    """Колонка source с категориями STRING_DTYPE, как у остальных категорий схемы."""
+    names = [source] if length else []
+    return pd.Categorical(names * length, categories=pd.Index(names, dtype=STRING_DTYPE))
+
+
+def parse_export(filepath: str) -> pd.DataFrame:
+    """Разбирает одну выгрузку; выполняется в процессе пула, поэтому функция модульная и без состояния."""
+    df = normalize_export(pd.read_excel(filepath))
+    df['source'] = source_column(os.path.basename(filepath), len(df))
+    return df
+
+
+def iter_export_chunks(filepaths: Sequence[str], chunk_size: int = 50000) -> Iterator[pd.DataFrame]:
+    """Потоково отдаёт нормализованные куски всех выгрузок без дублей по load.
+
+    Память ограничена размером куска: книга читается итератором openpyxl, а повторы грузов
+    отсекаются множеством уже отданных номеров. Порядок и приоритет те же, что у merge_exports:
+    более поздний файл списка идёт первым и побеждает, внутри файла — первая строка.
+    """
+    seen = set()
+    for filepath in reversed(filepaths):
+        source = os.path.basename(filepath)
+        for chunk in iter_excel_chunks(filepath, chunk_size, usecols=SOURCE_COLUMNS):
+            chunk = normalize_export(chunk)
+            keep = ~chunk['load'].duplicated() & ~chunk['load'].isin(seen)
+            dropped = int((~keep).sum())
+            if dropped:
+                logger.info(f"{dropped} duplicate loads dropped from {source}, later exports take precedence")
+            chunk = chunk[keep]
+            seen.update(chunk['load'])
+            if not chunk.empty:
+                chunk['source'] = source_column(source, len(chunk))
+                yield chunk
+
+
+def shared_pool(workers: int) -> ProcessPoolExecutor:
+    """Пул живёт всё время процесса: в сервисе воркеры не стартуют заново на каждое задание."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context(INGEST_START_METHOD))
+        return _pool
+
+
+def parse_exports(filepaths: Sequence[str], workers: int = INGEST_WORKERS) -> List[pd.DataFrame]:
+    """Разбирает выгрузки по одной на процесс; порядок результата совпадает с filepaths."""
+    if workers <= 1 or len(filepaths) <= 1:
+        return [parse_export(filepath) for filepath in filepaths]
+    pool = shared_pool(workers)
+    futures = [pool.submit(parse_export, filepath) for filepath in filepaths]
+    return [future.result() for future in futures]
+
+
+def empty_export() -> pd.DataFrame:
+    return normalize_export(pd.DataFrame(columns=SOURCE_COLUMNS)).assign(source=source_column('', 0))
+
+
+def merge_exports(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """Объединяет выгрузки без дублей по load: приоритет у более поздних файлов списка,
+    внутри файла — у первой строки (как раньше tutash перекрывал kgline)."""
+    if not frames:
+        return empty_export()
+    df = concat_frames(list(reversed(frames)))
+    duplicated = df['load'].duplicated()
+    if duplicated.any():
+        logger.info(f"{int(duplicated.sum())} duplicate loads dropped, later exports take precedence")
+    return df[~duplicated]
@@ -0,0 +1,103 @@
+import logging
+import os
+import time
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from utils.metrics import METRICS_REPORT_FOLDER, metrics
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+JOIN_REPORT_FOLDER = os.getenv('JOIN_REPORT_FOLDER', METRICS_REPORT_FOLDER)
+# Колонки строки выгрузки, которые попадают в отчёт о несопоставленных строках
+REPORT_COLUMNS = ['load', 'driver_id', 'driver', 'source']
+
+
+class KeyedLookup:
+    """Lookup таблица, индексированная по ключу один раз.
+
+    Связь один к одному: при повторе ключа используется первая строка, поэтому строка выгрузки
+    никогда не размножается (например, водитель с несколькими открытыми Vehicle_History__r).
+    С pyarrow ключи ищутся хэш-поиском Arrow (index_in) без перевода строк в object.
+    """
+
+    def __init__(self, frame: pd.DataFrame, key: str, name: str):
+        self.key = key
+        self.name = name
+        self.frame = frame.reset_index(drop=True)
+        keys = self.frame[key]
+        if pa is not None:
+            self.values = pa.array(keys, from_pandas=True)
+            duplicates = len(keys) - pc.count_distinct(self.values).as_py()
+        else:
+            first = ~keys.duplicated(keep='first').to_numpy()
+            self.index = pd.Index(keys[first])
+            self.first_positions = np.flatnonzero(first)
+            duplicates = len(keys) - len(self.index)
+        if duplicates:
+            logger.warning(f"Lookup {name}: {duplicates} duplicate {key} rows ignored, the first row per key is used")
+
+    def positions(self, keys: pd.Series) -> np.ndarray:
+        """Позиция строки lookup для каждого ключа, -1 если ключа нет (один проход по хэш-индексу)."""
+        if pa is not None:
+            keys = pa.array(keys, from_pandas=True)
+            found = pc.index_in(keys, value_set=self.values.cast(keys.type))
+            return found.fill_null(-1).to_numpy(zero_copy_only=False)
+        found = self.index.get_indexer(keys)
+        return np.where(found >= 0, self.first_positions[found], -1)
+
+    def take(self, positions: np.ndarray) -> pd.DataFrame:
+        """Колонки lookup кроме ключа для уже сопоставленных позиций."""
+        return self.frame.drop(columns=[self.key]).take(positions).reset_index(drop=True)
+
+
+def join_lookups(df: pd.DataFrame, lookups: List[KeyedLookup]) -> pd.DataFrame:
+    """Inner join кадра выгрузки со всеми lookup за один проход.
+
+    Несопоставленные строки не теряются молча: они учитываются в метриках join и
+    записываются в отчёт вместе с lookup, в которых не нашлось ключа.
+    """
+    matched = np.ones(len(df), dtype=bool)
+    positions = []
+    for lookup in lookups:
+        found = lookup.positions(df[lookup.key])
+        rows_in = int(matched.sum())
+        matched &= found >= 0
+        metrics.record_join(f'trip.{lookup.name}', rows_in, int(matched.sum()))
+        positions.append(found)
+
+    if not matched.all():
+        unmatched = ~matched
+        missing_from = pd.Series('', index=df.index[unmatched], dtype=object)
+        for lookup, found in zip(lookups, positions):
+            missing = found[unmatched] < 0
+            missing_from[missing] = missing_from[missing] + '+' + lookup.name
+        write_unmatched_report(df[unmatched], missing_from.str.lstrip('+'))
+    kept = df[matched].reset_index(drop=True)
+    parts = [kept] + [lookup.take(found[matched]) for lookup, found in zip(lookups, positions)]
+    return pd.concat(parts, axis=1)
+
+
+def write_unmatched_report(rows: pd.DataFrame, missing_from: pd.Series,
+                           folder: str = JOIN_REPORT_FOLDER) -> Optional[str]:
+    """Ключи несопоставленных строк и lookup без их ключа в сжатый CSV; в лог — только счётчики."""
+    summary = ', '.join(f'{count} missing from {names}' for names, count in missing_from.value_counts().items())
+    columns = [column for column in REPORT_COLUMNS if column in rows.columns]
+    report = rows[columns].assign(missing_from=missing_from.to_numpy())
+    try:
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"trip_unmatched_{time.strftime('%Y%m%d_%H%M%S')}.csv.gz")
+        report.to_csv(path, index=False, compression='gzip')
+        logger.warning(f"{len(report)} trip rows without lookup match ({summary}), see {path}")
+        return path
+    except Exception as e:
+        logger.error(f"Could not write unmatched rows report: {e}; {summary}")
+        return None
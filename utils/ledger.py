@@ -0,0 +1,63 @@
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import List, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+LEDGER_DB_PATH = os.getenv('LEDGER_DB_PATH', 'set/ledger.sqlite')
+
+
+def row_fingerprints(frame: pd.DataFrame, key_columns: List[str]) -> Tuple[pd.Series, pd.Series]:
+    """Возвращает ключ строки и хэш значений всех полей payload (векторно, через hash_pandas_object)."""
+    text = frame.astype('string').fillna('')
+    keys = text[key_columns[0]]
+    for column in key_columns[1:]:
+        keys = keys + '|' + text[column]
+    hashes = pd.util.hash_pandas_object(text, index=False).map('{:016x}'.format)
+    return keys.astype(object), hashes.astype(object)
+
+
+class FingerprintLedger:
+    """Журнал отпечатков отправленных строк: sObject + ключ -> хэш полей последней успешной загрузки."""
+
+    def __init__(self, db_path: str = LEDGER_DB_PATH):
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS fingerprints ('
+                'sobject TEXT NOT NULL, key TEXT NOT NULL, hash TEXT NOT NULL, updated_at TEXT NOT NULL, '
+                'PRIMARY KEY (sobject, key))'
+            )
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS ledger_keys (k TEXT PRIMARY KEY)')
+
+    def lookup(self, sobject: str, keys: pd.Series) -> pd.Series:
+        """Хэши из журнала, выровненные по keys; NaN для ключей, которых ещё не было."""
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM ledger_keys')
+            self._conn.executemany('INSERT OR IGNORE INTO ledger_keys (k) VALUES (?)', ((k,) for k in keys))
+            rows = self._conn.execute(
+                'SELECT f.key, f.hash FROM ledger_keys k JOIN fingerprints f ON f.sobject = ? AND f.key = k.k',
+                (sobject,)
+            ).fetchall()
+        return keys.map(dict(rows))
+
+    def record(self, sobject: str, keys: pd.Series, hashes: pd.Series):
+        """Сохраняет отпечатки успешно загруженных строк."""
+        if keys.empty:
+            return
+        stamp = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO fingerprints (sobject, key, hash, updated_at) VALUES (?, ?, ?, ?)',
+                ((sobject, key, value, stamp) for key, value in zip(keys, hashes))
+            )
+        logger.info(f"Ledger: recorded {len(keys)} {sobject} fingerprints")
@@ -0,0 +1,202 @@
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+METRICS_REPORT_FOLDER = os.getenv('METRICS_REPORT_FOLDER', 'set/reports/')
+METRICS_PREFIX = 'adv_load_recorder'
+
+# Стадия, к которой относятся вызовы Salesforce текущего потока
+_current_stage = contextvars.ContextVar('metrics_stage', default='unscoped')
+
+
+class StageTimer:
+    """Строки на входе и выходе, которые код стадии заполняет внутри with metrics.stage(...)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.rows_in: Optional[int] = None
+        self.rows_out: Optional[int] = None
+
+
+class RunMetrics:
+    """Потокобезопасный сборщик метрик процесса: время стадий, строки, потери на join, вызовы Salesforce."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = datetime.now(timezone.utc)
+            self.stages: Dict[str, dict] = {}
+            self.joins: Dict[str, dict] = {}
+            self.api_calls: Dict[Tuple[str, str, str], dict] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        timer = StageTimer(name)
+        token = _current_stage.set(name)
+        started = time.perf_counter()
+        failed = False
+        try:
+            yield timer
+        except Exception:
+            failed = True
+            raise
+        finally:
+            _current_stage.reset(token)
+            self.observe_stage(name, time.perf_counter() - started, timer.rows_in, timer.rows_out, failed)
+
+    def observe_stage(self, name: str, seconds: float, rows_in: Optional[int] = None,
+                      rows_out: Optional[int] = None, failed: bool = False):
+        with self._lock:
+            entry = self.stages.setdefault(name, {'runs': 0, 'failures': 0, 'seconds': 0.0,
+                                                  'rows_in': 0, 'rows_out': 0})
+            entry['runs'] += 1
+            entry['failures'] += int(failed)
+            entry['seconds'] += seconds
+            entry['rows_in'] += int(rows_in or 0)
+            entry['rows_out'] += int(rows_out or 0)
+
+    def record_join(self, name: str, rows_in: int, rows_out: int):
+        """Строки, потерянные inner join'ом."""
+        with self._lock:
+            entry = self.joins.setdefault(name, {'runs': 0, 'rows_in': 0, 'rows_out': 0, 'dropped': 0})
+            entry['runs'] += 1
+            entry['rows_in'] += rows_in
+            entry['rows_out'] += rows_out
+            entry['dropped'] += max(rows_in - rows_out, 0)
+        if rows_out < rows_in:
+            logger.info(f"Join {name}: {rows_in - rows_out} of {rows_in} rows dropped")
+
+    def record_api_call(self, api: str, method: str, seconds: float, bytes_sent: int, bytes_received: int,
+                        failed: bool = False):
+        key = (_current_stage.get(), api, method)
+        with self._lock:
+            entry = self.api_calls.setdefault(key, {'calls': 0, 'errors': 0, 'seconds': 0.0,
+                                                    'bytes_sent': 0, 'bytes_received': 0})
+            entry['calls'] += 1
+            entry['errors'] += int(failed)
+            entry['seconds'] += seconds
+            entry['bytes_sent'] += bytes_sent
+            entry['bytes_received'] += bytes_received
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'started_at': self.started_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'generated_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'stages': {name: dict(entry) for name, entry in self.stages.items()},
+                'joins': {name: dict(entry) for name, entry in self.joins.items()},
+                'api_calls': [dict(stage=stage, api=api, method=method, **entry)
+                              for (stage, api, method), entry in self.api_calls.items()],
+            }
+
+    def write_report(self, folder: str = METRICS_REPORT_FOLDER) -> Optional[str]:
+        """Сохраняет JSON отчёт запуска и возвращает путь к нему."""
+        try:
+            os.makedirs(folder, exist_ok=True)
+            path = os.path.join(folder, f"run_{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')}.json")
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f, indent=2)
+            logger.info(f"Run report saved to {path}")
+            return path
+        except Exception as e:
+            logger.error(f"Could not write run report: {e}")
+            return None
+
+    def prometheus_text(self) -> str:
+        """Метрики в текстовом формате Prometheus (счётчики с начала работы процесса)."""
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name: str, help_text: str, samples):
+            lines.append(f'# HELP {METRICS_PREFIX}_{name} {help_text}')
+            lines.append(f'# TYPE {METRICS_PREFIX}_{name} counter')
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{str(val)}"' for key, val in labels.items())
+                lines.append(f'{METRICS_PREFIX}_{name}{{{label_text}}} {value}')
+
+        stages = snapshot['stages'].items()
+        family('stage_runs_total', 'Stage executions.', [({'stage': n}, e['runs']) for n, e in stages])
+        family('stage_failures_total', 'Stage executions that raised.', [({'stage': n}, e['failures']) for n, e in stages])
+        family('stage_seconds_total', 'Stage wall time.', [({'stage': n}, round(e['seconds'], 6)) for n, e in stages])
+        family('stage_rows_in_total', 'Rows entering a stage.', [({'stage': n}, e['rows_in']) for n, e in stages])
+        family('stage_rows_out_total', 'Rows leaving a stage.', [({'stage': n}, e['rows_out']) for n, e in stages])
+        family('join_rows_dropped_total', 'Rows dropped by inner joins.',
+               [({'join': n}, e['dropped']) for n, e in snapshot['joins'].items()])
+        calls = [({'stage': c['stage'], 'api': c['api'], 'method': c['method']}, c) for c in snapshot['api_calls']]
+        family('sf_api_calls_total', 'Salesforce HTTP calls.', [(labels, c['calls']) for labels, c in calls])
+        family('sf_api_errors_total', 'Salesforce HTTP calls with status >= 400.', [(labels, c['errors']) for labels, c in calls])
+        family('sf_api_seconds_total', 'Time to response headers of Salesforce calls.',
+               [(labels, round(c['seconds'], 6)) for labels, c in calls])
+        family('sf_api_bytes_sent_total', 'Request bytes sent to Salesforce.', [(labels, c['bytes_sent']) for labels, c in calls])
+        family('sf_api_bytes_received_total', 'Response bytes declared by Salesforce.',
+               [(labels, c['bytes_received']) for labels, c in calls])
+        return '\n'.join(lines) + '\n'
+
+
+metrics = RunMetrics()
+
+
+def propagate_stage(func):
+    """Переносит текущую стадию в поток ThreadPoolExecutor, чтобы вызовы API попали в её метрики."""
+    stage = _current_stage.get()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current_stage.set(stage)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_stage.reset(token)
+    return wrapper
+
+
+def _api_kind(path: str) -> str:
+    if path.startswith('/services/async/'):
+        return 'bulk'
+    if path.startswith('/services/data/'):
+        return 'rest'
+    if path.startswith('/services/Soap/'):
+        return 'soap'
+    return 'other'
+
+
+def _body_size(body) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    # Файл батча после отправки стоит в конце: позиция равна отправленному объёму
+    try:
+        return body.tell()
+    except Exception:
+        return 0
+
+
+def _record_response(response, *args, **kwargs):
+    try:
+        request = response.request
+        metrics.record_api_call(
+            _api_kind(urlparse(request.url).path), request.method,
+            response.elapsed.total_seconds(), _body_size(request.body),
+            int(response.headers.get('Content-Length') or 0), failed=response.status_code >= 400,
+        )
+    except Exception as e:
+        logger.debug(f"Could not record API call metrics: {e}")
+
+
+def instrument_http_session(session):
+    """Подключает учёт вызовов Salesforce к общей requests.Session."""
+    session.hooks['response'].append(_record_response)
@@ -0,0 +1,85 @@
+import logging
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Часовые пояса, которые встречаются в PU Time / DEL Time выгрузки OpenRoad (смещение от UTC в часах)
+TIMEZONE_OFFSETS = {
+    'UTC': 0, 'GMT': 0,
+    'EST': -5, 'EDT': -4,
+    'CST': -6, 'CDT': -5,
+    'MST': -7, 'MDT': -6,
+    'PST': -8, 'PDT': -7,
+    'AKST': -9, 'AKDT': -8,
+    'HST': -10,
+}
+
+# "12/05/2024 08:00 - 16:00CST"
+APPOINTMENT_PATTERN = (
+    r'^(?P<date>\d{2}/\d{2}/\d{4})\s+'
+    r'(?P<start_time>\d+:\d+)\s*-\s*(?P<end_time>\d+:\d+)(?P<timezone>[A-Z]+)'
+)
+
+
+def _as_text(series: pd.Series) -> pd.Series:
+    return series.astype('string')
+
+
+def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Derives load, customer and driver fields with vectorized .str operations (string dtype)."""
+    customer = _as_text(df['customer']).str.rsplit(' ', n=1, expand=True)
+    if customer.shape[1] < 2:
+        # Пустой кадр или имена без пробела: добавленные reindex колонки — float, .str ниже их бы не принял
+        customer = customer.reindex(columns=[0, 1]).astype('string')
+    has_prefix = customer[1].notna()
+    # "BROKER NAME 12345" -> load "12345", customer "BROKER NAME"
+    # Двойной пробел перед номером ("ACME  12345") оставил бы хвостовой пробел в имени брокера
+    df['load'] = customer[1].where(has_prefix, customer[0]).fillna('').str.strip()
+    df['customer'] = customer[0].where(has_prefix, '').fillna('').str.strip()
+
+    # "1234 - John Smith (100.0%)"
+    driver = _as_text(df['driver'])
+    df['driver_id'] = driver.str.split(' - ', n=1).str[0].fillna('')
+    df['driver'] = (
+        driver.str.split(' - ', n=2).str[1]
+        .str.replace(' (100.0%)', '', regex=False)
+        .fillna('')
+    )
+    return df
+
+
+def parse_appointment_column(series: pd.Series, label: str = 'time') -> pd.DataFrame:
+    """Разбирает колонку времени окна в два datetime столбца (start, end) в UTC за один проход."""
+    text = _as_text(series)
+    parts = text.str.extract(APPOINTMENT_PATTERN)
+
+    start = pd.to_datetime(parts['date'] + ' ' + parts['start_time'], format='%m/%d/%Y %H:%M', errors='coerce')
+    end = pd.to_datetime(parts['date'] + ' ' + parts['end_time'], format='%m/%d/%Y %H:%M', errors='coerce')
+    # Окно через полночь: "22:00 - 02:00" заканчивается на следующий день
+    end = end.where(~(end < start), end + pd.Timedelta(days=1))
+
+    offsets = pd.to_timedelta(parts['timezone'].map(TIMEZONE_OFFSETS).astype(float), unit='h')
+    start = (start - offsets).dt.tz_localize('UTC')
+    end = (end - offsets).dt.tz_localize('UTC')
+
+    unmatched = text.notna() & text.ne('') & parts['date'].isna()
+    if unmatched.any():
+        logger.error(f"Time format is incorrect in {int(unmatched.sum())} {label} rows, e.g. {text[unmatched].iloc[0]!r}")
+    unknown_tz = parts['timezone'].notna() & ~parts['timezone'].isin(list(TIMEZONE_OFFSETS))
+    if unknown_tz.any():
+        logger.warning(f"Unknown timezone in {label}: {sorted(parts['timezone'][unknown_tz].unique())}")
+
+    return pd.DataFrame({'start': start, 'end': end}, index=series.index)
+
+
+def add_appointment_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """Adds pu_start/pu_end and del_start/del_end UTC columns from pu_time and del_time."""
+    for prefix in ('pu', 'del'):
+        column = f'{prefix}_time'
+        if column not in df.columns:
+            continue
+        parsed = parse_appointment_column(df[column], label=column)
+        df[f'{prefix}_start'] = parsed['start']
+        df[f'{prefix}_end'] = parsed['end']
+    return df
+
@@ -0,0 +1,198 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+from utils.metrics import metrics
+
+if TYPE_CHECKING:
+    from utils.run_journal import RunJournal
+
+logger = logging.getLogger(__name__)
+
+# Стадии, которые пользователь выбирает через --stages
+PUBLIC_STAGES = ['load', 'stops', 'trips']
+
+
+class StageFailed(Exception):
+    pass
+
+
+class Stage:
+    """Стадия пайплайна.
+
+    deps    — жёсткие зависимости: подтягиваются автоматически и должны завершиться успешно.
+    after   — только порядок: учитываются, если стадия выбрана в этом запуске.
+    save    — выходной кадр стадии для журнала запуска (context, result) -> DataFrame.
+    restore — восстанавливает стадию из журнала (context, result, frame) -> result;
+              стадии без restore при повторном запуске выполняются заново.
+    """
+
+    def __init__(self, name: str, func: Callable[[Dict[str, Any]], Any],
+                 deps: Sequence[str] = (), after: Sequence[str] = (),
+                 save: Optional[Callable[[Dict[str, Any], Any], Any]] = None,
+                 restore: Optional[Callable[[Dict[str, Any], Any, Any], Any]] = None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.after = list(after)
+        self.save = save
+        self.restore = restore
+
+
+class PipelineRunner:
+    """Запускает стадии по готовности зависимостей, независимые стадии идут параллельно."""
+
+    def __init__(self, stages: List[Stage], max_workers: int = 4, journal: Optional['RunJournal'] = None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.max_workers = max_workers
+        self.journal = journal
+        self.results: Dict[str, Any] = {}
+
+    def resolve(self, selected: Iterable[str]) -> List[str]:
+        """Выбранные стадии плюс все их жёсткие зависимости."""
+        resolved = []
+
+        def visit(name: str):
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage '{name}', expected one of {PUBLIC_STAGES}")
+            if name in resolved:
+                return
+            for dep in self.stages[name].deps:
+                visit(dep)
+            resolved.append(name)
+
+        for name in selected:
+            visit(name)
+        return resolved
+
+    def run_stage(self, name: str) -> Any:
+        stage = self.stages[name]
+        checkpointed = self.journal is not None and stage.restore is not None
+        with metrics.stage(f'pipeline.{name}'):
+            if checkpointed and self.journal.is_done(name):
+                logger.info(f"Stage '{name}' restored from run journal {self.journal.run_id}")
+                return stage.restore(self.results, self.journal.stage_result(name), self.journal.stage_frame(name))
+            result = stage.func(self.results)
+            if checkpointed:
+                frame = stage.save(self.results, result) if stage.save else None
+                self.journal.complete_stage(name, None if frame is not None else result, frame)
+            return result
+
+    def run(self, selected: Iterable[str]) -> Dict[str, str]:
+        """Выполняет стадии и возвращает их итоговые состояния (done, failed, skipped)."""
+        scheduled = self.resolve(selected)
+        waits_for = {
+            name: set(self.stages[name].deps) | {a for a in self.stages[name].after if a in scheduled}
+            for name in scheduled
+        }
+        states: Dict[str, str] = {}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(states) < len(scheduled):
+                for name in scheduled:
+                    if name in states or name in running.values():
+                        continue
+                    blockers = waits_for[name]
+                    if any(states.get(dep) in ('failed', 'skipped') for dep in blockers):
+                        states[name] = 'skipped'
+                        logger.error(f"Stage '{name}' skipped: a dependency did not complete")
+                    elif all(states.get(dep) == 'done' for dep in blockers):
+                        logger.info(f"Stage '{name}' started")
+                        running[executor.submit(self.run_stage, name)] = name
+
+                if not running:
+                    continue
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                        states[name] = 'done'
+                        logger.info(f"Stage '{name}' finished")
+                    except Exception as e:
+                        states[name] = 'failed'
+                        logger.error(f"Stage '{name}' failed: {e}")
+        if self.journal is not None:
+            self.journal.finish(states)
+        return states
+
+
+def build_pipeline(excel_files: List[str], save_folder: str, max_workers: int = 4,
+                   resume: Optional[bool] = None, fresh: bool = False) -> PipelineRunner:
+    """Load -> Stop_Position -> Trip на одном разобранном наборе данных.
+
+    Lookup водителей и техники не зависит от загрузок и идёт параллельно с Load__c job,
+    lookup Id стопов и Trip__c ждут завершения Load__c и Stop_Position__c job (если они выбраны).
+    При resume запуск ведёт журнал: упавший запуск на тех же файлах продолжается с места
+    остановки, а fresh начинает его заново. По умолчанию resume берётся из RUN_JOURNAL.
+    """
+    # pandas и клиенты Salesforce загружаются только при сборке пайплайна, а не при импорте модуля
+    from utils.job import DataSet, LoadRecord, PickupDelivery, Trip
+    from utils.run_journal import RUN_JOURNAL_ENABLED, RunJournal
+
+    if resume is None:
+        resume = RUN_JOURNAL_ENABLED
+    journal = RunJournal.for_inputs(excel_files) if resume else None
+    if journal is not None and fresh:
+        journal.discard()
+
+    def journaled(processor):
+        # Bulk job'ы процессора записываются в журнал, чтобы повторный запуск к ним переподключился
+        processor.journal = journal
+        return processor
+
+    def summary(context, result, frame):
+        return result
+
+    def require(result: Optional[dict], object_name: str):
+        if result is None:
+            raise StageFailed(f"{object_name} bulk job failed")
+        return result
+
+    def dataset(context):
+        # Первый разбор Excel прогревает кэш, остальные стадии получают копии
+        return DataSet(excel_files)
+
+    def trip_dataset(context):
+        return journaled(Trip(excel_files, save_folder, prepare=False))
+
+    def load(context):
+        return require(journaled(LoadRecord(excel_files)).process_load_records(), 'Load__c')
+
+    def stops(context):
+        return require(journaled(PickupDelivery(excel_files)).picup_dlvr_loader(), 'Stop_Position__c')
+
+    def driver_lookup(context):
+        # Упавший lookup не попадает в журнал и повторяется при следующем запуске
+        if not context['trip_dataset'].fetch_driver_lookup():
+            raise StageFailed('driver vehicle lookup failed')
+
+    def stop_lookup(context):
+        if not context['trip_dataset'].fetch_stop_lookup():
+            raise StageFailed('stop position lookup failed')
+
+    def save_lookup(attribute):
+        return lambda context, result: getattr(context['trip_dataset'], attribute)
+
+    def restore_lookup(attribute):
+        return lambda context, result, frame: setattr(context['trip_dataset'], attribute, frame)
+
+    def trips(context):
+        trip = context['trip_dataset']
+        trip.data_merge()
+        return require(trip.process_trip_records(), 'Trip__c')
+
+    # dataset и trip_dataset не журналируются: разобранный кадр уже лежит в parquet кэше DataSet
+    return PipelineRunner([
+        Stage('dataset', dataset),
+        Stage('load', load, deps=['dataset'], restore=summary),
+        Stage('stops', stops, deps=['dataset'], after=['load'], restore=summary),
+        Stage('trip_dataset', trip_dataset, deps=['dataset']),
+        Stage('driver_lookup', driver_lookup, deps=['trip_dataset'],
+              save=save_lookup('trip_data'), restore=restore_lookup('trip_data')),
+        Stage('stop_lookup', stop_lookup, deps=['trip_dataset'], after=['load', 'stops'],
+              save=save_lookup('csv_data'), restore=restore_lookup('csv_data')),
+        # Trip__c ссылается на LOAD__r.LOAD_NUMBER__c: при выбранной стадии load ждём её job
+        Stage('trips', trips, deps=['driver_lookup', 'stop_lookup'], after=['load'], restore=summary),
+    ], max_workers=max_workers, journal=journal)
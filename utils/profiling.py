@@ -0,0 +1,145 @@
+import cProfile
+import functools
+import io
+import itertools
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Optional
+
+from utils.metrics import METRICS_REPORT_FOLDER
+
+logger = logging.getLogger(__name__)
+
+# Включается PIPELINE_PROFILE=true или main.py --profile; выключенный режим стоит одну проверку флага
+PROFILE_ENABLED = os.getenv('PIPELINE_PROFILE', 'false').lower() in ('1', 'true', 'yes')
+PROFILE_FOLDER = os.getenv('PIPELINE_PROFILE_FOLDER', os.path.join(METRICS_REPORT_FOLDER, 'profiles'))
+PROFILE_TOP_ALLOCATIONS = int(os.getenv('PIPELINE_PROFILE_TOP', '25'))
+# Глубина стека аллокаций tracemalloc; больше — точнее, но медленнее
+PROFILE_TRACE_FRAMES = int(os.getenv('PIPELINE_PROFILE_FRAMES', '1'))
+
+
+class StageProfiler:
+    """Снимает cProfile и tracemalloc с вызовов помеченных методов и пишет их в папку запуска.
+
+    На каждый вызов: <метод>_<n>.prof (открывается pstats/snakeviz) и <метод>_<n>.txt
+    со временем, пиком памяти, топом аллокаций и топом функций по cumulative.
+    """
+
+    def __init__(self, folder: str = PROFILE_FOLDER, enabled: bool = PROFILE_ENABLED):
+        self.enabled = enabled
+        self.folder = folder
+        self.run_folder: Optional[str] = None
+        self._sequence = itertools.count(1)
+        self._lock = threading.Lock()
+        self._tracing = 0
+        self._started_tracing = False
+        self._local = threading.local()
+        # cProfile может быть активен только один на процесс (Python 3.12+: sys.monitoring),
+        # поэтому параллельные стадии профилируются по очереди
+        self._profile_lock = threading.Lock()
+
+    def enable(self, folder: Optional[str] = None):
+        self.folder = folder or self.folder
+        self.enabled = True
+
+    def output_folder(self) -> str:
+        with self._lock:
+            if self.run_folder is None:
+                self.run_folder = os.path.join(self.folder, datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ'))
+                os.makedirs(self.run_folder, exist_ok=True)
+                logger.info(f"Profiling enabled, output in {self.run_folder}")
+            return self.run_folder
+
+    def start_tracing(self):
+        # tracemalloc общий на процесс: параллельные стадии делят одну трассировку
+        with self._lock:
+            if self._tracing == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(PROFILE_TRACE_FRAMES)
+                self._started_tracing = True
+            self._tracing += 1
+
+    def stop_tracing(self):
+        with self._lock:
+            self._tracing -= 1
+            # Трассировку, запущенную не нами (например, бенчмарком), не останавливаем
+            if self._tracing == 0 and self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+    def call(self, name: str, func, *args, **kwargs):
+        # Вложенный помеченный вызов в том же потоке попадает в профиль внешнего
+        if getattr(self._local, 'active', False):
+            return func(*args, **kwargs)
+        with self._profile_lock:
+            self._local.active = True
+            try:
+                return self.profile_call(name, func, *args, **kwargs)
+            finally:
+                self._local.active = False
+
+    def profile_call(self, name: str, func, *args, **kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Профилировщик, запущенный не нами (например, python -m cProfile): стадия идёт без профиля
+            logger.warning(f"Profiling of {name} skipped: {e}")
+            return func(*args, **kwargs)
+        profile.disable()
+        self.start_tracing()
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            profile.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+        finally:
+            seconds = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1]
+            after = tracemalloc.take_snapshot()
+            self.stop_tracing()
+            self.write(name, profile, before, after, seconds, peak)
+
+    def write(self, name: str, profile: cProfile.Profile, before, after, seconds: float, peak: int):
+        try:
+            base = os.path.join(self.output_folder(), f'{name}_{next(self._sequence)}')
+            profile.dump_stats(f'{base}.prof')
+            filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+            allocations = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+            functions = io.StringIO()
+            pstats.Stats(profile, stream=functions).sort_stats('cumulative').print_stats(PROFILE_TOP_ALLOCATIONS)
+            with open(f'{base}.txt', 'w', encoding='utf-8') as f:
+                f.write(f'{name}: {seconds:.3f}s, traced memory peak {peak / 2 ** 20:.1f} MB\n\n')
+                f.write(f'Top {PROFILE_TOP_ALLOCATIONS} allocations (growth during the call):\n')
+                for stat in allocations[:PROFILE_TOP_ALLOCATIONS]:
+                    f.write(f'  {stat}\n')
+                f.write('\n')
+                f.write(functions.getvalue())
+            logger.info(f"Profile of {name} ({seconds:.2f}s, peak {peak / 2 ** 20:.1f} MB) saved to {base}.prof")
+        except Exception as e:
+            logger.error(f"Could not write profile of {name}: {e}")
+
+
+profiler = StageProfiler()
+
+
+def profiled(func):
+    """Декоратор метода стадии: при включённом профилировании снимает cProfile и tracemalloc.
+
+    Файлы называются по классу объекта (LoadRecord.send_bulk_data, Trip.send_bulk_data),
+    а не по классу, где объявлен метод.
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not profiler.enabled:
+            return func(self, *args, **kwargs)
+        return profiler.call(f'{type(self).__name__}.{func.__name__}', func, self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,96 @@
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, List, Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+REFERENCE_DB_PATH = os.getenv('REFERENCE_DB_PATH', 'set/reference.sqlite')
+
+# Таблица -> (ключ, колонки lookup)
+REFERENCE_TABLES = {
+    'stop_positions': ('load', ['pickup_id', 'delivery_id']),
+    'driver_vehicles': ('driver_id', ['vehicle_type', 'unit_id', 'vehicle_id']),
+}
+
+
+def format_sf_timestamp(value: datetime) -> str:
+    """Формат datetime литерала SOQL, он же хранится в sync_state."""
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class ReferenceStore:
+    """Локальный SQLite кэш справочных данных Salesforce (Id стопов по грузу, техника водителя).
+
+    Строки индексированы по номеру груза и DRIVER_ID__c; synced_at строки — момент её последней
+    загрузки из Salesforce, с него же запрашиваются её изменения по SystemModstamp.
+    """
+
+    def __init__(self, db_path: str = REFERENCE_DB_PATH):
+        self.db_path = db_path
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            for table, (key, columns) in REFERENCE_TABLES.items():
+                column_defs = ', '.join(f'{column} TEXT' for column in columns)
+                self._conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS {table} ({key} TEXT PRIMARY KEY, {column_defs}, synced_at TEXT NOT NULL)'
+                )
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS lookup_keys (k TEXT PRIMARY KEY)')
+
+    def oldest_sync(self, table: str, values: List[str]) -> Optional[str]:
+        """Самый ранний synced_at среди уже закэшированных ключей values; None, если их нет."""
+        key, _ = REFERENCE_TABLES[table]
+        with self._lock, self._conn:
+            self._load_keys(values)
+            row = self._conn.execute(
+                f'SELECT MIN(t.synced_at) FROM lookup_keys k JOIN {table} t ON t.{key} = k.k'
+            ).fetchone()
+        return row[0] if row else None
+
+    def upsert(self, table: str, frame: Optional[pd.DataFrame], synced_at: datetime) -> int:
+        """Записывает плоский lookup frame; при дублях ключа остаётся первая строка."""
+        if frame is None or frame.empty:
+            return 0
+        key, columns = REFERENCE_TABLES[table]
+        frame = frame[[key] + columns].drop_duplicates(key)
+        frame = frame[frame[key].notna()].astype(object)
+        frame = frame.where(frame.notna(), None)
+        stamp = format_sf_timestamp(synced_at)
+        rows = [row + (stamp,) for row in frame.itertuples(index=False, name=None)]
+        placeholders = ', '.join('?' * (len(columns) + 2))
+        with self._lock, self._conn:
+            self._conn.executemany(f'INSERT OR REPLACE INTO {table} VALUES ({placeholders})', rows)
+        return len(rows)
+
+    def _load_keys(self, values: Iterable[str]):
+        self._conn.execute('DELETE FROM lookup_keys')
+        self._conn.executemany('INSERT OR IGNORE INTO lookup_keys (k) VALUES (?)', ((v,) for v in values))
+
+    def stale_keys(self, table: str, values: List[str], max_age: timedelta) -> List[str]:
+        """Ключи, которых нет в кэше или которые синхронизированы раньше max_age."""
+        key, _ = REFERENCE_TABLES[table]
+        cutoff = format_sf_timestamp(datetime.now(timezone.utc) - max_age)
+        with self._lock, self._conn:
+            self._load_keys(values)
+            rows = self._conn.execute(
+                f'SELECT k.k FROM lookup_keys k LEFT JOIN {table} t ON t.{key} = k.k '
+                f'WHERE t.{key} IS NULL OR t.synced_at < ?', (cutoff,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def get_frame(self, table: str, values: List[str]) -> pd.DataFrame:
+        """Возвращает lookup строки по ключам через индекс первичного ключа."""
+        key, columns = REFERENCE_TABLES[table]
+        with self._lock, self._conn:
+            self._load_keys(values)
+            rows = self._conn.execute(
+                f'SELECT t.{key}, {", ".join("t." + c for c in columns)} FROM lookup_keys k JOIN {table} t ON t.{key} = k.k'
+            ).fetchall()
+        return pd.DataFrame(rows, columns=[key] + columns)
@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Any, Dict, Optional, Sequence
+
+import pandas as pd
+
+from utils.dataset_cache import PARQUET_AVAILABLE, dataset_cache
+
+logger = logging.getLogger(__name__)
+
+RUN_JOURNAL_ENABLED = os.getenv('RUN_JOURNAL', 'true').lower() in ('1', 'true', 'yes')
+RUN_JOURNAL_FOLDER = os.getenv('RUN_JOURNAL_FOLDER', 'set/runs/')
+
+
+class RunJournal:
+    """Журнал запуска пайплайна на конкретном наборе выгрузок.
+
+    Хранит завершённые стадии (сводку и выходной кадр в parquet) и отправленные Bulk job'ы с Id батчей.
+    Повторный запуск на тех же файлах пропускает завершённые стадии и дожидается уже отправленных
+    job'ов вместо повторной отправки. После полностью успешного запуска журнал удаляется.
+    """
+
+    def __init__(self, run_id: str, folder: str = RUN_JOURNAL_FOLDER):
+        self.run_id = run_id
+        self.path = os.path.join(folder, run_id)
+        self._lock = threading.Lock()
+        self.state: Dict[str, Any] = {'run_id': run_id, 'started_at': time.time(), 'stages': {}, 'bulk_jobs': {}}
+        self.load()
+
+    @classmethod
+    def for_inputs(cls, filepaths: Sequence[str], folder: str = RUN_JOURNAL_FOLDER) -> 'RunJournal':
+        """Id запуска — хэш содержимого выгрузок, тот же, что у кэша разобранного DataSet."""
+        return cls(dataset_cache.make_key(list(filepaths)), folder)
+
+    @property
+    def journal_path(self) -> str:
+        return os.path.join(self.path, 'journal.json')
+
+    def load(self):
+        if not os.path.exists(self.journal_path):
+            return
+        try:
+            with open(self.journal_path, encoding='utf-8') as f:
+                self.state = json.load(f)
+            logger.info(f"Resuming run {self.run_id}: completed stages {list(self.state['stages'])}, "
+                        f"bulk jobs {[entry['job'] for entry in self.state['bulk_jobs'].values()]}")
+        except Exception as e:
+            logger.warning(f"Run journal {self.journal_path} is unreadable, starting over: {e}")
+
+    def save(self):
+        """Вызывается под self._lock."""
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f'{self.journal_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, default=str)
+        os.replace(tmp_path, self.journal_path)
+
+    def is_done(self, stage: str) -> bool:
+        return stage in self.state['stages']
+
+    def complete_stage(self, stage: str, result: Any = None, frame: Optional[pd.DataFrame] = None):
+        """Отмечает стадию завершённой; кадр пишется до записи в журнал, чтобы журнал не ссылался на неполный файл."""
+        entry = {'result': result, 'frame': None, 'completed_at': time.time()}
+        if frame is not None:
+            if not PARQUET_AVAILABLE:
+                logger.debug(f"pyarrow is not installed, stage '{stage}' is not checkpointed")
+                return
+            os.makedirs(self.path, exist_ok=True)
+            entry['frame'] = f'{stage}.parquet'
+            tmp_path = os.path.join(self.path, f"{entry['frame']}.tmp")
+            frame.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, os.path.join(self.path, entry['frame']))
+        with self._lock:
+            self.state['stages'][stage] = entry
+            self.save()
+
+    def stage_result(self, stage: str) -> Any:
+        return self.state['stages'][stage]['result']
+
+    def stage_frame(self, stage: str) -> Optional[pd.DataFrame]:
+        name = self.state['stages'][stage]['frame']
+        return pd.read_parquet(os.path.join(self.path, name)) if name else None
+
+    def bulk_job(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self.state['bulk_jobs'].get(key)
+            return json.loads(json.dumps(entry)) if entry else None
+
+    def start_bulk_job(self, key: str, job: str):
+        with self._lock:
+            self.state['bulk_jobs'][key] = {'job': job, 'state': 'open', 'batches': []}
+            self.save()
+
+    def add_bulk_batch(self, key: str, batch: dict):
+        """Батч записывается сразу после отправки: при обрыве он не будет отправлен повторно."""
+        with self._lock:
+            self.state['bulk_jobs'][key]['batches'].append(batch)
+            self.save()
+
+    def close_bulk_job(self, key: str, sent_keys: Optional[pd.DataFrame] = None):
+        """Отмечает job закрытым; sent_keys — ключи и отпечатки отправленных delta строк.
+
+        По ним повторный запуск восстанавливает тот же payload, даже если ledger уже обновлён.
+        """
+        name = None
+        if sent_keys is not None and PARQUET_AVAILABLE:
+            os.makedirs(self.path, exist_ok=True)
+            name = f'{key}_sent.parquet'
+            tmp_path = os.path.join(self.path, f'{name}.tmp')
+            sent_keys.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, os.path.join(self.path, name))
+        with self._lock:
+            self.state['bulk_jobs'][key]['state'] = 'closed'
+            self.state['bulk_jobs'][key]['sent_keys'] = name
+            self.save()
+
+    def sent_keys(self, key: str) -> Optional[pd.DataFrame]:
+        """Ключи строк, отправленных в закрытый job из журнала; None, если их нет."""
+        entry = self.bulk_job(key)
+        if not entry or not entry.get('sent_keys'):
+            return None
+        return pd.read_parquet(os.path.join(self.path, entry['sent_keys']))
+
+    def finish(self, states: Dict[str, str]) -> bool:
+        """Удаляет журнал, если все стадии запуска завершились; иначе оставляет его для повтора."""
+        if any(state != 'done' for state in states.values()):
+            logger.info(f"Run journal kept in {self.path}, rerun with the same exports to resume")
+            return False
+        self.discard()
+        return True
+
+    def discard(self):
+        with self._lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.state = {'run_id': self.run_id, 'started_at': time.time(), 'stages': {}, 'bulk_jobs': {}}
@@ -1,47 +1,182 @@
 import logging
 import pandas as pd
-from io import StringIO
-from simple_salesforce import Salesforce
-from salesforce_bulk import SalesforceBulk
-from dotenv import load_dotenv
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from simple_salesforce import Salesforce, SalesforceLogin
 import os
-import requests
-from typing import Optional, List
+import threading
+from urllib.parse import quote_plus
+from typing import Optional, List, Dict, Iterable, Iterator, Tuple
+from utils.bulk_csv import CsvBatch, CsvBatchWriter
+from utils.flatten import STOP_COLUMNS, flatten_stop_positions, flatten_vehicle_history, pivot_stop_rows
+from utils.reference_store import ReferenceStore
+from utils.ledger import FingerprintLedger, row_fingerprints
+from utils.metrics import metrics, instrument_http_session, propagate_stage
+from utils.profiling import profiled
+from utils.run_journal import RunJournal
+from utils.sf_session import (ReauthSalesforceBulk, clear_cached_session, create_http_session,
+                               load_cached_session, save_cached_session)
+from datetime import datetime, timedelta, timezone
+import gzip
+import json
 
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Загружаем переменные из .env файла
-load_dotenv()
+# Лимиты Bulk API на один батч
+MAX_BATCH_RECORDS = 10000
+MAX_BATCH_BYTES = 10 * 1024 * 1024
+
+BULK_POST_WORKERS = int(os.getenv('BULK_POST_WORKERS', '4'))
+BULK_POLL_INTERVAL = float(os.getenv('BULK_POLL_INTERVAL', '2'))
+BULK_POLL_MAX_INTERVAL = float(os.getenv('BULK_POLL_MAX_INTERVAL', '30'))
+BULK_TIMEOUT = float(os.getenv('BULK_TIMEOUT', '3600'))
+BATCH_FINAL_STATES = ('Completed', 'Failed', 'NotProcessed')
+# SOQL уходит в query string GET запроса, поэтому ограничиваем длину URL, а не количество значений
+MAX_QUERY_URL_LENGTH = int(os.getenv('SOQL_MAX_URL_LENGTH', '16000'))
+QUERY_URL_OVERHEAD = 200
+QUERY_WORKERS = int(os.getenv('SOQL_QUERY_WORKERS', '4'))
+# Сохранять сырые ответы lookup запросов в set/*.jsonl.gz
+DEBUG_SNAPSHOT = os.getenv('TRIP_DEBUG_SNAPSHOT', 'false').lower() in ('1', 'true', 'yes')
+# Lookup стопов через Bulk API query job вместо сотен REST запросов, если грузов не меньше порога
+BULK_QUERY_THRESHOLD = int(os.getenv('BULK_QUERY_THRESHOLD', '5000'))
+BULK_QUERY_PK_CHUNK = int(os.getenv('BULK_QUERY_PK_CHUNK', '100000'))
+# Ограничить Bulk выборку грузами, созданными за N дней (0 — без ограничения); в выгрузке текущие грузы
+BULK_QUERY_LOOKBACK_DAYS = int(os.getenv('BULK_QUERY_LOOKBACK_DAYS', '90'))
+BULK_QUERY_READ_ROWS = 50000
+# Локальный кэш справочных данных для TripDataset (utils/reference_store.py)
+REFERENCE_CACHE_ENABLED = os.getenv('REFERENCE_CACHE', 'true').lower() in ('1', 'true', 'yes')
+SYNC_CLOCK_SKEW = timedelta(minutes=5)
+# Изменения в Vehicle_History__r не меняют SystemModstamp водителя, поэтому техника перечитывается чаще
+REFERENCE_MAX_AGE = {
+    'stop_positions': timedelta(hours=float(os.getenv('REFERENCE_MAX_AGE_HOURS_STOPS', '168'))),
+    'driver_vehicles': timedelta(hours=float(os.getenv('REFERENCE_MAX_AGE_HOURS_DRIVERS', '24'))),
+}
+REFERENCE_DELTA_CONDITIONS = {
+    'stop_positions': 'Id IN (SELECT LOAD__c FROM Stop_Position__c WHERE SystemModstamp > {since})',
+    'driver_vehicles': 'SystemModstamp > {since}',
+}
+# Delta загрузки: отправляем только строки, изменившиеся с прошлого успешного запуска (utils/ledger.py).
+# Выключены по умолчанию: upsert Load__c требует, чтобы Load_Number__c был External ID в org
+DELTA_UPLOADS = os.getenv('DELTA_UPLOADS', 'false').lower() in ('1', 'true', 'yes')
+# Колонки payload, по которым строка sObject сопоставляется с прошлыми запусками
+DELTA_KEYS = {
+    'Load__c': ['Load_Number__c'],
+    'Stop_Position__c': ['LOAD__r.Load_Number__c', 'TYPE__c'],
+    'Trip__c': ['LOAD__r.LOAD_NUMBER__c'],
+}
+# External ID для upsert; дополняется через BULK_EXTERNAL_IDS="Trip__c=Trip_Key__c,..."
+UPSERT_EXTERNAL_IDS = {'Load__c': 'Load_Number__c'}
+UPSERT_EXTERNAL_IDS.update(
+    item.split('=', 1) for item in os.getenv('BULK_EXTERNAL_IDS', '').split(',') if '=' in item
+)
+BROKER_CACHE_PATH = os.getenv('BROKER_CACHE_PATH', 'set/broker_cache.json')
+BROKER_CACHE_TTL = float(os.getenv('BROKER_CACHE_TTL_HOURS', '168')) * 3600
+# Повтор строк, отклонённых из-за временных ошибок
+RETRYABLE_ERRORS = ['UNABLE_TO_LOCK_ROW', 'REQUEST_RUNNING_TOO_LONG', 'SERVER_UNAVAILABLE']
+RETRYABLE_ERRORS_PATTERN = '|'.join(RETRYABLE_ERRORS)
+RETRY_ATTEMPTS = int(os.getenv('BULK_RETRY_ATTEMPTS', '3'))
+RETRY_BATCH_SIZE = int(os.getenv('BULK_RETRY_BATCH_SIZE', '200'))
+RETRY_BACKOFF = float(os.getenv('BULK_RETRY_BACKOFF', '5'))
+REJECTS_FOLDER = os.getenv('BULK_REJECTS_FOLDER', 'set/rejects/')
+# Объекты, которые грузим в Serial режиме: строки Trip__c одного водителя блокируют друг друга
+SERIAL_OBJECTS = set(filter(None, os.getenv('BULK_SERIAL_OBJECTS', 'Trip__c').split(',')))
 
 
 class SalesforceAuthentication:
     # Атрибуты класса для хранения сессий, общих для всех экземпляров
     sf_rest_session = None
     sf_bulk_session = None
+    http_session = None
+    _auth_lock = threading.RLock()
+
+    @staticmethod
+    def credentials() -> Dict[str, str]:
+        credentials = {
+            'username': os.getenv('SALESFORCE_USERNAME'),
+            'password': os.getenv('SALESFORCE_PASSWORD'),
+            'security_token': os.getenv('SALESFORCE_TOKEN'),
+            'domain': os.getenv('SALESFORCE_DOMAIN'),
+        }
+        if not all(credentials.values()):
+            raise ValueError("One or more Salesforce authentication environment variables are missing.")
+        return credentials
 
     @classmethod
-    def initialize_salesforce_session(cls):
-        """Авторизуемся в Salesforce и сохраняем сессии для REST API и Bulk API для последующего использования."""
+    def login(cls) -> Tuple[str, str]:
+        """Полный SOAP логин; новая сессия сохраняется в дисковый кэш."""
+        credentials = cls.credentials()
+        session_id, instance = SalesforceLogin(session=cls.http_session, **credentials)
+        save_cached_session(credentials['username'], session_id, instance)
+        logger.info("Successfully authenticated to Salesforce.")
+        return session_id, instance
+
+    @classmethod
+    def build_clients(cls, session_id: str, instance: str):
+        sf = Salesforce(session_id=session_id, instance=instance, session=cls.http_session)
+        # simple_salesforce сам повторяет запрос после INVALID_SESSION_ID, если знает, как перелогиниться
+        def relogin():
+            cls.refresh_session(sf.session_id)
+            return sf.session_id, sf.sf_instance
+
+        sf._salesforce_login_partial = relogin
+        bulk = ReauthSalesforceBulk(sessionId=session_id, host=instance, session=cls.http_session,
+                                    reauthenticate=cls.refresh_session)
+        return sf, bulk
+
+    @classmethod
+    def session_is_valid(cls, sf: Salesforce) -> bool:
+        """Дешёвая проверка сессии: список ресурсов REST API текущей версии."""
         try:
-            username = os.getenv('SALESFORCE_USERNAME')
-            password = os.getenv('SALESFORCE_PASSWORD')
-            security_token = os.getenv('SALESFORCE_TOKEN')
-            domain = os.getenv('SALESFORCE_DOMAIN')
+            response = cls.http_session.get(sf.base_url, headers=sf.headers, timeout=30)
+            return response.status_code == 200
+        except Exception as e:
+            logger.warning(f"Session check failed: {e}")
+            return False
 
-            if not all([username, password, security_token, domain]):
-                raise ValueError("One or more Salesforce authentication environment variables are missing.")
+    @classmethod
+    def initialize_salesforce_session(cls):
+        """Авторизуемся в Salesforce и сохраняем сессии для REST API и Bulk API для последующего использования.
 
+        Сначала пробуем session id из дискового кэша, полный логин — только если он не прошёл проверку.
+        """
+        with cls._auth_lock:
+            try:
+                if cls.http_session is None:
+                    cls.http_session = create_http_session()
+                    instrument_http_session(cls.http_session)
+                cached = load_cached_session(cls.credentials()['username'])
+                if cached:
+                    sf, bulk = cls.build_clients(*cached)
+                    if cls.session_is_valid(sf):
+                        logger.info("Reusing cached Salesforce session.")
+                        cls.sf_rest_session, cls.sf_bulk_session = sf, bulk
+                        return
+                    clear_cached_session()
+                cls.sf_rest_session, cls.sf_bulk_session = cls.build_clients(*cls.login())
+            except Exception as e:
+                logger.error(f"Authentication error: {str(e)}")
+                cls.sf_rest_session, cls.sf_bulk_session = None, None
 
-            sf = Salesforce(username=username, password=password, security_token=security_token, domain=domain)
-            bulk = SalesforceBulk(sessionId=sf.session_id, host=sf.sf_instance)
-            logger.info("Successfully authenticated to Salesforce.")
-            cls.sf_rest_session = sf
-            cls.sf_bulk_session = bulk
-        except Exception as e:
-            logger.error(f"Authentication error: {str(e)}")
-            cls.sf_rest_session, cls.sf_bulk_session = None, None
+    @classmethod
+    def refresh_session(cls, stale_session_id: str) -> str:
+        """Перелогинивается после истечения сессии и обновляет оба клиента.
+
+        Если другой поток уже обновил сессию, повторного логина не будет.
+        """
+        with cls._auth_lock:
+            sf, bulk = cls.sf_rest_session, cls.sf_bulk_session
+            if sf is not None and sf.session_id != stale_session_id:
+                return sf.session_id
+            logger.warning("Salesforce session expired, re-authenticating")
+            session_id, instance = cls.login()
+            if sf is not None:
+                sf.session_id, sf.sf_instance = session_id, instance
+                sf._generate_headers()
+            if bulk is not None:
+                bulk.sessionId = session_id
+            return session_id
 
     @classmethod
     def get_sessions(cls):
@@ -55,60 +190,539 @@ class BulkLoadProcessor(SalesforceAuthentication):
     def __init__(self):
         super().__init__()
         self.load_data = []
+        self.load_frames = []
+        # Журнал запуска: отправленные job'ы и батчи, чтобы повторный запуск не отправлял их снова
+        self.journal: Optional[RunJournal] = None
 
     def add_load(self, load_record):
         self.load_data.append(load_record)
 
-    def send_bulk_data(self, text):
-        df = pd.DataFrame(self.load_data)
-        csv_buffer = StringIO()
-        df.to_csv(csv_buffer, index=False)
-        self.csv_data = csv_buffer.getvalue()
+    def add_frame(self, frame: pd.DataFrame):
+        """Добавляет уже спроецированный по полям sObject DataFrame."""
+        self.load_frames.append(frame)
+
+    def iter_payload_frames(self) -> Iterator[pd.DataFrame]:
+        yield from self.load_frames
+        if self.load_data:
+            yield pd.DataFrame(self.load_data)
 
-        if not self.csv_data.strip():
-            logger.info("No data to send.")
+    _ledger = None
+
+    @classmethod
+    def shared_ledger(cls) -> FingerprintLedger:
+        if BulkLoadProcessor._ledger is None:
+            BulkLoadProcessor._ledger = FingerprintLedger()
+        return BulkLoadProcessor._ledger
+
+    def iter_delta_frames(self, object_name: str, external_id: Optional[str], fingerprints: List[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """Отдаёт только новые и изменившиеся строки payload, собирая их отпечатки в fingerprints.
+
+        Без external id изменившиеся строки пропускаются: insert создал бы дубликаты.
+        """
+        ledger = self.shared_ledger()
+        key_columns = DELTA_KEYS[object_name]
+        for frame in self.iter_payload_frames():
+            keys, hashes = row_fingerprints(frame, key_columns)
+            known = ledger.lookup(object_name, keys)
+            is_new = known.isna()
+            changed = ~is_new & (known != hashes)
+            send = (is_new | changed) if external_id else is_new
+            send &= ~keys.duplicated()
+            if not external_id and changed.any():
+                logger.warning(f"{int(changed.sum())} changed {object_name} rows skipped: no external id configured for upsert")
+            logger.info(f"Delta {object_name}: {int((send & is_new).sum())} new, {int((send & changed).sum())} changed, "
+                        f"{int((~send).sum())} unchanged or skipped of {len(frame)}")
+            fingerprints.append(pd.DataFrame({'key': keys[send], 'hash': hashes[send]}))
+            yield frame[send]
+
+    def iter_journaled_frames(self, object_name: str, sent_keys: pd.DataFrame,
+                              fingerprints: List[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """Повторяет delta выборку закрытого job из журнала по сохранённым ключам, а не по ledger.
+
+        Ledger мог быть обновлён до сбоя, и тогда delta фильтр дал бы меньше строк, чем было отправлено.
+        """
+        key_columns = DELTA_KEYS[object_name]
+        for frame in self.iter_payload_frames():
+            keys, hashes = row_fingerprints(frame, key_columns)
+            send = keys.isin(sent_keys['key']) & ~keys.duplicated()
+            fingerprints.append(pd.DataFrame({'key': keys[send], 'hash': hashes[send]}))
+            yield frame[send]
+
+    def record_fingerprints(self, object_name: str, fingerprints: List[pd.DataFrame], positions: pd.Index):
+        """Записывает в журнал отпечатки строк, успешно загруженных в Salesforce."""
+        if not fingerprints or positions.empty:
             return
-        
-        job = None
+        sent = pd.concat(fingerprints, ignore_index=True).iloc[positions]
+        self.shared_ledger().record(object_name, sent['key'], sent['hash'])
+
+    @staticmethod
+    def job_concurrency(object_name: str) -> str:
+        """Serial для объектов с конфликтами блокировок, иначе Parallel."""
+        return 'Serial' if object_name in SERIAL_OBJECTS else 'Parallel'
+
+    def post_batches(self, job, batches: Iterable[CsvBatch], parallel: bool,
+                     journal_key: Optional[str] = None) -> List[dict]:
+        """Отправляет батчи в один job по мере их заполнения; в Parallel режиме до BULK_POST_WORKERS одновременно."""
+        def post(batch: CsvBatch) -> dict:
+            try:
+                batch_id = self.sf_bulk_session.post_batch(job, batch.rewind())
+                posted = {'id': batch_id, 'start': batch.start, 'records': batch.records}
+                if journal_key:
+                    self.journal.add_bulk_batch(journal_key, posted)
+                return posted
+            finally:
+                batch.close()
+
+        if not parallel:
+            return [post(batch) for batch in batches]
+
+        posted = []
+        with ThreadPoolExecutor(max_workers=BULK_POST_WORKERS) as executor:
+            in_flight = []
+            for batch in batches:
+                # Не держим больше BULK_POST_WORKERS готовых файлов одновременно
+                if len(in_flight) >= BULK_POST_WORKERS:
+                    posted.append(in_flight.pop(0).result())
+                in_flight.append(executor.submit(propagate_stage(post), batch))
+            posted.extend(future.result() for future in in_flight)
+        return posted
+
+    def wait_for_batches(self, job, batch_ids: List[str]) -> Dict[str, dict]:
+        """Опрашивает статус всех батчей job одним запросом списка батчей за раунд, с экспоненциальной паузой."""
+        statuses = {}
+        pending = list(batch_ids)
+        interval = BULK_POLL_INTERVAL
+        deadline = time.monotonic() + BULK_TIMEOUT
+        while pending:
+            batches = self.sf_bulk_session.get_batch_list(job)
+            batches = [batches] if isinstance(batches, dict) else batches
+            listed = {batch['id']: batch for batch in batches}
+            for batch_id in list(pending):
+                status = listed.get(batch_id, {})
+                if status.get('state') in BATCH_FINAL_STATES:
+                    statuses[batch_id] = status
+                    pending.remove(batch_id)
+                    if status.get('state') != 'Completed':
+                        logger.error(f"Batch {batch_id} finished with state {status.get('state')}: {status.get('stateMessage')}")
+            if not pending:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Bulk job {job}: {len(pending)} batches still running after {BULK_TIMEOUT}s")
+            time.sleep(interval)
+            interval = min(interval * 1.5, BULK_POLL_MAX_INTERVAL)
+        return statuses
+
+    def run_bulk_job(self, text: str, frames: Iterable[pd.DataFrame], concurrency: str,
+                     external_id: Optional[str] = None, max_records: int = MAX_BATCH_RECORDS,
+                     journal_key: Optional[str] = None,
+                     fingerprints: Optional[List[pd.DataFrame]] = None) -> Optional[Tuple[str, List[dict], Dict[str, dict]]]:
+        """Создаёт job, потоково отправляет батчи и ждёт их завершения. None, если отправлять нечего.
+
+        С journal_key job и батчи записываются в журнал запуска, а уже записанный job
+        переиспользуется вместо создания нового. fingerprints (delta режим) сохраняются
+        в журнал при закрытии job.
+        """
+        journal_key = journal_key if self.journal is not None else None
+        tracked = self.journal.bulk_job(journal_key) if journal_key else None
+        if tracked:
+            return self.reattach_bulk_job(journal_key, tracked, frames, concurrency, max_records, fingerprints)
+
+        writer = CsvBatchWriter(max_records, MAX_BATCH_BYTES)
+        batches = writer.iter_batches(frames)
+        first = next(batches, None)
+        if first is None:
+            return None
+
+        if external_id:
+            job = self.sf_bulk_session.create_upsert_job(f"{text}", external_id_name=external_id,
+                                                         contentType='CSV', concurrency=concurrency)
+        else:
+            job = self.sf_bulk_session.create_insert_job(f"{text}", contentType='CSV', concurrency=concurrency)
+        if journal_key:
+            self.journal.start_bulk_job(journal_key, job)
+        posted = None
         try:
-            job = self.sf_bulk_session.create_insert_job(f"{text}", contentType='CSV')
-            batch = self.sf_bulk_session.post_batch(job, self.csv_data)
-            logger.debug(f"Batch response: {batch}")
-            self.sf_bulk_session.wait_for_batch(job, batch)
-            logger.info(f"Bulk operation completed for {len(self.load_data)} records.")
-        except AttributeError as e:
-            logger.error(f"Method not found: {e}")
-        except Exception as e:
-            logger.error(f"An error occurred during bulk processing: {e}")
+            posted = self.post_batches(job, chain([first], batches), parallel=concurrency == 'Parallel',
+                                       journal_key=journal_key)
+            logger.debug(f"Batch response: {posted}")
         finally:
-            if job:
+            # Закрываем job сразу после отправки батчей, чтобы Salesforce не ждал новых.
+            # Журналируемый job после сбоя остаётся открытым: повторный запуск дошлёт остальные батчи
+            if posted is not None or not journal_key:
                 self.sf_bulk_session.close_job(job)
-            self.load_data = []
-
-
+        if journal_key:
+            self.journal.close_bulk_job(journal_key, self.sent_keys(fingerprints))
+        statuses = self.wait_for_batches(job, [batch['id'] for batch in posted])
+        return job, posted, statuses
+
+    @staticmethod
+    def sent_keys(fingerprints: Optional[List[pd.DataFrame]]) -> Optional[pd.DataFrame]:
+        if fingerprints is None:
+            return None
+        if not fingerprints:
+            return pd.DataFrame({'key': pd.Series(dtype=str), 'hash': pd.Series(dtype=str)})
+        return pd.concat(fingerprints, ignore_index=True)
+
+    def reattach_bulk_job(self, journal_key: str, tracked: dict, frames: Iterable[pd.DataFrame], concurrency: str,
+                          max_records: int, fingerprints: Optional[List[pd.DataFrame]] = None
+                          ) -> Tuple[str, List[dict], Dict[str, dict]]:
+        """Продолжает job из журнала: досылает не отправленные батчи (если job не закрыт) и ждёт результатов.
+
+        Payload строится заново из тех же выгрузок, поэтому батчи совпадают по позициям строк
+        (delta строки закрытого job берутся по ключам из журнала, см. iter_journaled_frames).
+        """
+        job = tracked['job']
+        posted = tracked['batches']
+        logger.info(f"Reattaching to {journal_key} bulk job {job}: {len(posted)} batches already posted")
+        if tracked['state'] == 'open':
+            state = self.sf_bulk_session.job_status(job).get('state')
+            if state != 'Open':
+                raise RuntimeError(f"Bulk job {job} from the run journal is {state} and cannot take the remaining "
+                                   f"batches, rerun with --fresh")
+            # salesforce_bulk знает content type только job'ов, созданных этим клиентом
+            self.sf_bulk_session.jobs[job] = job
+            self.sf_bulk_session.job_content_types[job] = 'CSV'
+            known = {batch['start'] for batch in posted}
+
+            def unposted():
+                for batch in CsvBatchWriter(max_records, MAX_BATCH_BYTES).iter_batches(frames):
+                    if batch.start in known:
+                        batch.close()
+                    else:
+                        yield batch
+
+            posted = posted + self.post_batches(job, unposted(), parallel=concurrency == 'Parallel',
+                                                journal_key=journal_key)
+            self.sf_bulk_session.close_job(job)
+            self.journal.close_bulk_job(journal_key, self.sent_keys(fingerprints))
+        else:
+            # Кадры всё равно проходят через генератор: send_bulk_data собирает по ним sent_frames и отпечатки
+            for _ in frames:
+                pass
+        statuses = self.wait_for_batches(job, [batch['id'] for batch in posted])
+        return job, sorted(posted, key=lambda batch: batch['start']), statuses
+
+    def fetch_results(self, job: str, posted: List[dict], statuses: Dict[str, dict]) -> pd.DataFrame:
+        """Читает результаты всех батчей и сопоставляет их строкам payload по позиции."""
+        frames = []
+        for batch in posted:
+            status = statuses.get(batch['id'], {})
+            try:
+                results = self.sf_bulk_session.get_batch_results(batch['id'], job) or []
+            except Exception as e:
+                logger.error(f"Could not fetch results of batch {batch['id']}: {e}")
+                results = []
+            rows = [(r.id, str(r.success).lower() == 'true', str(r.error or '')) for r in results[:batch['records']]]
+            # Батч в состоянии Failed не возвращает строк: вся пачка считается отклонённой
+            missing = batch['records'] - len(rows)
+            rows.extend([(None, False, f"{status.get('state')}: {status.get('stateMessage')}")] * missing)
+            frames.append(pd.DataFrame(rows, columns=['id', 'success', 'error'],
+                                       index=pd.RangeIndex(batch['start'], batch['start'] + batch['records'])))
+        if not frames:
+            return pd.DataFrame(columns=['id', 'success', 'error'])
+        return pd.concat(frames).sort_index()
+
+    @staticmethod
+    def take_rows(frames: List[pd.DataFrame], positions: pd.Index) -> pd.DataFrame:
+        """Строки отправленного payload по глобальным позициям, без склейки всех кадров."""
+        parts = []
+        offset = 0
+        positions = positions.sort_values()
+        for frame in frames:
+            local = positions[(positions >= offset) & (positions < offset + len(frame))] - offset
+            if len(local):
+                parts.append(frame.iloc[local])
+            offset += len(frame)
+        return pd.concat(parts) if parts else pd.DataFrame()
+
+    def retry_failed(self, text: str, sent_frames: List[pd.DataFrame], outcome: pd.DataFrame,
+                     external_id: Optional[str]) -> int:
+        """Повторно отправляет только строки с временными ошибками (UNABLE_TO_LOCK_ROW и т.п.)
+        маленькими Serial батчами с нарастающей паузой. Обновляет outcome на месте."""
+        retried = 0
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            failed = outcome[~outcome['success']]
+            retryable = failed.index[failed['error'].str.contains(RETRYABLE_ERRORS_PATTERN, regex=True)]
+            if retryable.empty:
+                break
+            delay = RETRY_BACKOFF * 2 ** (attempt - 1)
+            logger.warning(f"Retrying {len(retryable)} {text} rows with retryable errors (attempt {attempt}) in {delay:.0f}s")
+            time.sleep(delay)
+            rows = self.take_rows(sent_frames, retryable)
+            job_result = self.run_bulk_job(text, [rows], 'Serial', external_id, max_records=RETRY_BATCH_SIZE)
+            if job_result is None:
+                break
+            retry_outcome = self.fetch_results(*job_result)
+            retry_outcome.index = retryable.sort_values()[retry_outcome.index]
+            outcome.loc[retry_outcome.index, ['id', 'success', 'error']] = retry_outcome[['id', 'success', 'error']]
+            outcome['success'] = outcome['success'].astype(bool)
+            retried += len(retryable)
+        return retried
+
+    def write_rejects(self, text: str, sent_frames: List[pd.DataFrame], outcome: pd.DataFrame) -> Optional[str]:
+        """Сохраняет окончательно отклонённые строки с текстом ошибки в сжатый CSV."""
+        failed = outcome[~outcome['success']]
+        if failed.empty:
+            return None
+        rows = self.take_rows(sent_frames, failed.index).reset_index(drop=True)
+        rows['error'] = failed['error'].to_numpy()
+        os.makedirs(REJECTS_FOLDER, exist_ok=True)
+        file_path = os.path.join(REJECTS_FOLDER, f"{text}_{time.strftime('%Y%m%d_%H%M%S')}.csv.gz")
+        rows.to_csv(file_path, index=False, compression='gzip')
+        logger.error(f"{len(rows)} {text} rows rejected, see {file_path}")
+        return file_path
 
-class ObjectMapper(SalesforceAuthentication):
-    def __init__(self):
+    @profiled
+    def send_bulk_data(self, text, concurrency: Optional[str] = None, delta: Optional[bool] = None) -> Optional[dict]:
+        """Отправляет накопленный payload; возвращает сводку по job или None, если job не выполнился."""
+        delta = (DELTA_UPLOADS if delta is None else delta) and text in DELTA_KEYS
+        external_id = UPSERT_EXTERNAL_IDS.get(text) if delta else None
+        fingerprints = []
+        sent_frames = []
+        journaled_keys = self.journal.sent_keys(text) if delta and self.journal is not None else None
+        if journaled_keys is not None:
+            frames = self.iter_journaled_frames(text, journaled_keys, fingerprints)
+        elif delta:
+            frames = self.iter_delta_frames(text, external_id, fingerprints)
+        else:
+            frames = self.iter_payload_frames()
+
+        def track(frames_iter):
+            # Запоминаем отправленные кадры, чтобы сопоставить результаты с исходными строками
+            for frame in frames_iter:
+                if not frame.empty:
+                    sent_frames.append(frame)
+                    yield frame
+
+        concurrency = concurrency or self.job_concurrency(text)
+        summary = None
+        with metrics.stage(f'bulk.{text}') as stage:
+            stage.rows_in = sum(len(frame) for frame in self.load_frames) + len(self.load_data)
+            try:
+                job_result = self.run_bulk_job(text, track(frames), concurrency, external_id, journal_key=text,
+                                               fingerprints=fingerprints if delta else None)
+                if job_result is None:
+                    logger.info("No data to send.")
+                    return {'job': None, 'records': 0, 'batches': 0, 'failed': 0, 'retried': 0, 'rejects': None}
+
+                job, posted, statuses = job_result
+                outcome = self.fetch_results(job, posted, statuses)
+                retried = self.retry_failed(text, sent_frames, outcome, external_id)
+                rejects = self.write_rejects(text, sent_frames, outcome)
+                if delta:
+                    fingerprints = [fp for fp in fingerprints if not fp.empty]
+                    self.record_fingerprints(text, fingerprints, outcome.index[outcome['success'].to_numpy(dtype=bool)])
+
+                failed = int((~outcome['success']).sum())
+                logger.info(f"Bulk operation completed for {len(outcome)} records in {len(posted)} batches ({concurrency}), "
+                            f"{retried} retried, {failed} failed.")
+                summary = {'job': job, 'records': len(outcome), 'batches': len(posted), 'failed': failed,
+                           'retried': retried, 'rejects': rejects}
+                stage.rows_out = len(outcome) - failed
+            except AttributeError as e:
+                logger.error(f"Method not found: {e}")
+            except Exception as e:
+                logger.error(f"An error occurred during bulk processing: {e}")
+            finally:
+                self.load_data = []
+                self.load_frames = []
+        return summary
+
+
+
+class SoqlQueryExecutor(SalesforceAuthentication):
+    """Выполняет SOQL с длинными IN (...) списками: куски по лимиту длины запроса,
+    пул потоков на общей сессии и полный проход по nextRecordsUrl."""
+
+
+    @staticmethod
+    def quote_soql(value) -> str:
+        text = str(value).replace('\\', '\\\\').replace("'", "\\'")
+        return f"'{text}'"
+
+    def chunk_values(self, query_template: str, values: list, max_batch_size: Optional[int] = None) -> List[List[str]]:
+        """Делит значения IN на куски так, чтобы URL запроса не превышал MAX_QUERY_URL_LENGTH."""
+        budget = MAX_QUERY_URL_LENGTH - len(quote_plus(query_template.format(load_numbers_str=''))) - QUERY_URL_OVERHEAD
+        chunks, current, used = [], [], 0
+        for value in values:
+            cost = len(quote_plus(self.quote_soql(value) + ','))
+            if current and (used + cost > budget or (max_batch_size and len(current) >= max_batch_size)):
+                chunks.append(current)
+                current, used = [], 0
+            current.append(value)
+            used += cost
+        if current:
+            chunks.append(current)
+        return chunks
+
+    def query_all_pages(self, query: str) -> List[dict]:
+        """Выполняет запрос и дочитывает все страницы через query_more."""
+        result = self.sf_rest_session.query(query)
+        records = list(result.get('records', []))
+        while not result.get('done', True):
+            result = self.sf_rest_session.query_more(result['nextRecordsUrl'], identifier_is_url=True)
+            records.extend(result.get('records', []))
+        return records
+
+    def run_chunked_query(self, query_template: str, values: list, max_batch_size: Optional[int] = None) -> List[dict]:
+        """Выполняет query_template для всех значений параллельно и возвращает общий список записей."""
+        query_template = ' '.join(query_template.split())
+        unique_values = list(dict.fromkeys(str(v) for v in values if v is not None and pd.notna(v) and str(v) != ''))
+        chunks = self.chunk_values(query_template, unique_values, max_batch_size)
+        if not chunks:
+            return []
+
+        def run(chunk: List[str]) -> List[dict]:
+            query = query_template.format(load_numbers_str=','.join(self.quote_soql(v) for v in chunk))
+            try:
+                return self.query_all_pages(query)
+            except Exception as query_error:
+                logger.error(f"Query failed for chunk of {len(chunk)} values starting with {chunk[0]!r}: {str(query_error)}")
+                return []
+
+        records = []
+        with ThreadPoolExecutor(max_workers=min(QUERY_WORKERS, len(chunks))) as executor:
+            for chunk_records in executor.map(propagate_stage(run), chunks):
+                records.extend(chunk_records)
+        logger.info(f"Fetched {len(records)} records for {len(unique_values)} values in {len(chunks)} queries")
+        return records
+
+    def wait_for_query_batches(self, job: str, original: str, chunked: bool) -> List[str]:
+        """Ждёт завершения query job; при PK chunking исходный батч становится NotProcessed,
+        а данные приходят в батчах-кусках. Возвращает Id батчей с результатами."""
+        interval = BULK_POLL_INTERVAL
+        deadline = time.monotonic() + BULK_TIMEOUT
+        while True:
+            batches = self.sf_bulk_session.get_batch_list(job)
+            batches = [batches] if isinstance(batches, dict) else batches
+            states = {batch['id']: batch for batch in batches}
+            first = states.get(original, {})
+            failed = [batch for batch in batches if batch.get('state') == 'Failed']
+            if failed:
+                raise RuntimeError(f"Bulk query job {job} failed: {failed[0].get('stateMessage')}")
+            if first.get('state') == 'Completed':
+                return [original]
+            chunks = [batch for batch_id, batch in states.items() if batch_id != original]
+            if chunked and first.get('state') == 'NotProcessed' and chunks \
+                    and all(batch.get('state') == 'Completed' for batch in chunks):
+                return [batch['id'] for batch in chunks]
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Bulk query job {job} still running after {BULK_TIMEOUT}s")
+            time.sleep(interval)
+            interval = min(interval * 1.5, BULK_POLL_MAX_INTERVAL)
+
+    def run_bulk_query(self, object_name: str, soql: str, usecols: List[str],
+                       pk_chunk_size: int = BULK_QUERY_PK_CHUNK) -> Iterator[pd.DataFrame]:
+        """Выполняет SOQL как Bulk API query job и потоково отдаёт результат кусками DataFrame."""
+        bulk = self.sf_bulk_session
+        job = bulk.create_query_job(object_name, contentType='CSV', pk_chunking=pk_chunk_size or False)
+        try:
+            original = bulk.query(job, ' '.join(soql.split()))
+        finally:
+            bulk.close_job(job)
+        batch_ids = self.wait_for_query_batches(job, original, chunked=bool(pk_chunk_size))
+        logger.info(f"Bulk query job {job} on {object_name} completed in {len(batch_ids)} batches")
+        for batch_id in batch_ids:
+            for result_id in bulk.get_query_batch_result_ids(batch_id, job_id=job) or []:
+                stream = bulk.get_query_batch_results(batch_id, result_id, job_id=job, raw=True)
+                stream.decode_content = True
+                yield from pd.read_csv(stream, dtype=str, usecols=usecols, keep_default_na=False,
+                                       chunksize=BULK_QUERY_READ_ROWS)
+
+
+class ObjectMapper(SoqlQueryExecutor, BulkLoadProcessor):
+    def __init__(self, cache_path: str = BROKER_CACHE_PATH):
         super().__init__()
         self.broker_map = {}
-        # Настройка логирования
-        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        self.broker_cached_at = {}
+        self.cache_path = cache_path
         self.logger = logging.getLogger(__name__)
+        self.load_broker_cache()
+
+    def load_broker_cache(self):
+        """Читает кэш имя брокера -> Id Account, выбрасывая записи старше BROKER_CACHE_TTL."""
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                cached = json.load(f)
+            now = time.time()
+            self.broker_map = {name: entry['id'] for name, entry in cached.items()
+                               if now - entry['cached_at'] < BROKER_CACHE_TTL}
+            self.broker_cached_at = {name: cached[name]['cached_at'] for name in self.broker_map}
+            self.logger.info(f"Loaded {len(self.broker_map)} cached brokers ({len(cached) - len(self.broker_map)} expired)")
+        except Exception as e:
+            self.logger.warning(f"Broker cache {self.cache_path} is unreadable, ignoring it: {e}")
+            self.broker_map = {}
+
+    def save_broker_cache(self):
+        now = time.time()
+        data = {name: {'id': broker_id, 'cached_at': self.broker_cached_at.get(name, now)} for name, broker_id in self.broker_map.items()}
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        tmp_path = f'{self.cache_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.cache_path)
 
     def get_broker_map(self, broker_name: str) -> dict:
         self.logger.info(f"Fetching broker map for broker: {broker_name}")
-        
-        broker = self.find_broker_by_name(broker_name)
-        if not broker:
-            self.logger.warning(f"Broker '{broker_name}' not found, creating a new one.")
-            broker = self.create_broker_in_account(broker_name)
-
+        self.resolve_brokers([broker_name])
         self.logger.info(f"Broker map fetched for broker: {broker_name}")
         return self.broker_map
 
+    def resolve_brokers(self, names) -> Dict[str, str]:
+        """Возвращает имя -> Id Account для всех брокеров: кэш, затем IN запросы, недостающих создаём одним Bulk insert."""
+        distinct = list(dict.fromkeys(str(n).strip() for n in names if n is not None and pd.notna(n) and str(n).strip()))
+        unresolved = [name for name in distinct if name not in self.broker_map]
+        if unresolved:
+            records = self.run_chunked_query("SELECT Id, Name FROM Account WHERE Name IN ({load_numbers_str})", unresolved)
+            # Сравнение имён в SOQL регистронезависимое
+            found = {record['Name'].upper(): record['Id'] for record in records}
+            missing = []
+            for name in unresolved:
+                if name.upper() in found:
+                    self.broker_map[name] = found[name.upper()]
+                else:
+                    missing.append(name)
+            self.logger.info(f"Brokers: {len(distinct) - len(unresolved)} cached, {len(unresolved) - len(missing)} found, {len(missing)} to create")
+            if missing:
+                self.broker_map.update(self.create_brokers_bulk(missing))
+            self.save_broker_cache()
+        return {name: self.broker_map[name] for name in distinct if name in self.broker_map}
+
+    @staticmethod
+    def broker_account_data(name: str) -> dict:
+        if 'AMAZON' in name.upper():
+            return {'Name': name, 
+                    'Type': 'Broker', 
+                    'AMAZON__c': True}
+        return {'Name': name, 
+                'Type': 'Broker', 
+                'STREETLOAD__c': True, 
+                'PROOF_OF_DELIVERY__c': True, 
+                'RATE_CONFIRMATION__c': True}
+
+    def create_brokers_bulk(self, names: List[str]) -> Dict[str, str]:
+        """Создаёт Account брокеров одним Bulk insert и возвращает имя -> Id созданных."""
+        accounts = pd.DataFrame([self.broker_account_data(name) for name in names])
+        accounts = accounts.map(lambda value: 'true' if value is True else value)
+        job_result = self.run_bulk_job('Account', [accounts], 'Parallel')
+        if job_result is None:
+            return {}
+        outcome = self.fetch_results(*job_result)
+
+        created = {}
+        for position, row in outcome.iterrows():
+            if row['success']:
+                created[names[position]] = row['id']
+            else:
+                self.logger.error(f"Broker '{names[position]}' was not created: {row['error']}")
+        self.logger.info(f"Created {len(created)} of {len(names)} brokers")
+        return created
+
     def find_broker_by_name(self, name):
         self.logger.info(f"Searching for broker with name: {name}")
-        query = f"SELECT Id, Name FROM Account WHERE Name = '{name}'"
+        query = f"SELECT Id, Name FROM Account WHERE Name = {self.quote_soql(name)}"
         
         try:
             result = self.sf_rest_session.query(query)
@@ -124,19 +738,9 @@ class ObjectMapper(SalesforceAuthentication):
     def create_broker_in_account(self, name):
         self.logger.info(f"Creating a new broker account with name: {name}")
         try:
-            if 'AMAZON' in name.upper():
-                account_data = {'Name': name, 
-                                'Type': 'Broker', 
-                                'AMAZON__c': True}
-                self.logger.debug(f"Account data for AMAZON: {account_data}")
-            else:
-                account_data = {'Name': name, 
-                                'Type': 'Broker', 
-                                'STREETLOAD__c': True, 
-                                'PROOF_OF_DELIVERY__c': True, 
-                                'RATE_CONFIRMATION__c': True}
-                self.logger.debug(f"Account data for other broker: {account_data}")
-                
+            account_data = self.broker_account_data(name)
+            self.logger.debug(f"Account data for broker: {account_data}")
+
             account = self.sf_rest_session.Account.create(account_data)
             self.logger.info(f"Broker '{name}' created with ID: {account['id']}")
             return account
@@ -145,89 +749,168 @@ class ObjectMapper(SalesforceAuthentication):
             raise
 
 
-class TripSetter(SalesforceAuthentication):
-    def __init__(self, save_folder: str):
-        super().__init__()
-        self.save_folder = save_folder
+STOP_POSITIONS_QUERY = """
+    SELECT Id, Load_Number__c, (SELECT Id, TYPE__c FROM Stop_Positions__r) 
+    FROM Load__c 
+    WHERE {condition}
+"""
 
-    def get_data_csv(self, result) -> Optional[pd.DataFrame]:
-        """Сохраняет данные в CSV, если записи существуют."""
-        try:
-            if not result or 'records' not in result or not result['records']:
-                logger.warning("No records found for the provided query")
-                return None
+# Bulk query не поддерживает подзапросы, поэтому стопы читаются из Stop_Position__c и группируются локально
+STOP_POSITIONS_BULK_QUERY = """
+    SELECT Id, TYPE__c, LOAD__r.Load_Number__c
+    FROM Stop_Position__c
+    WHERE {condition}
+"""
 
-            # Сохранение данных в CSV
-            df = pd.DataFrame(result['records']).drop(columns='attributes', errors='ignore')
-            return df
-        except Exception as e:
-            logger.error(f"Error saving data to CSV: {str(e)}")
-            return None
+DRIVER_VEHICLES_QUERY = """
+    SELECT Id, DRIVER_ID__c, FirstName, LastName, 
+    (SELECT Id, TYPE__c, END_DATE__c, UNIT__c FROM Vehicle_History__r WHERE END_DATE__c = null) 
+    FROM Account 
+    WHERE RecordType.DeveloperName = 'DriverAccount'
+    AND {condition}
+"""
 
-    def execute_batched_query(self, query_template: str, load_numbers: list, batch_size: int, file_suffix: str) -> str:
-        """Executes batched queries and saves the results in a CSV file."""
-        df = pd.DataFrame()  # Initialize an empty DataFrame
 
-        for i in range(0, len(load_numbers), batch_size):
-            batch = load_numbers[i:i + batch_size]
-            load_numbers_str = ','.join([f"'{num}'" for num in batch])
-            query = query_template.format(load_numbers_str=load_numbers_str)
-
-            try:
-                result = self.sf_rest_session.query(query)
-                middle = self.get_data_csv(result)
-                if middle is not None:
-                    df = pd.concat([df, middle], ignore_index=True)  # Safely append results
-                else:
-                    logger.warning(f"No data for batch {i} to {i + batch_size - 1}")
-            except Exception as query_error:
-                logger.error(f"Query failed for batch {i} to {i + batch_size - 1}: {str(query_error)}")
-        
-        # Construct file path with suffix
-        file_name = f'{file_suffix}.csv'
-        file_path = os.path.join(self.save_folder, file_name)
-        df.to_csv(file_path, index=False)
-        logger.info(f"Data successfully saved to {file_path}")
+class TripSetter(SoqlQueryExecutor):
+    _reference_store = None
 
-        return file_path
+    def __init__(self, save_folder: str, debug_snapshot: Optional[bool] = None,
+                 reference_store: Optional[ReferenceStore] = None):
+        super().__init__()
+        self.save_folder = save_folder
+        self.debug_snapshot = DEBUG_SNAPSHOT if debug_snapshot is None else debug_snapshot
+        if reference_store is None and REFERENCE_CACHE_ENABLED:
+            reference_store = TripSetter.shared_reference_store()
+        self.reference_store = reference_store
 
-    def making_trip_sql_request(self, load_numbers: List[str]) -> Optional[str]:
-        """Скачивает CSV с информацией о поездках."""
+    @classmethod
+    def shared_reference_store(cls) -> ReferenceStore:
+        if TripSetter._reference_store is None:
+            TripSetter._reference_store = ReferenceStore()
+        return TripSetter._reference_store
+
+    def write_snapshot(self, records: List[dict], file_suffix: str):
+        """Сохраняет сырые записи в сжатый JSON Lines для отладки."""
+        os.makedirs(self.save_folder, exist_ok=True)
+        file_path = os.path.join(self.save_folder, f'{file_suffix}.jsonl.gz')
+        with gzip.open(file_path, 'wt', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, default=str))
+                f.write('\n')
+        logger.info(f"Debug snapshot saved to {file_path}")
+
+    @profiled
+    def execute_batched_query(self, query_template: str, load_numbers: list, file_suffix: str,
+                              batch_size: Optional[int] = None) -> List[dict]:
+        """Executes chunked queries concurrently and returns the raw records."""
+        records = self.run_chunked_query(query_template, load_numbers, max_batch_size=batch_size)
+        if not records:
+            logger.warning("No records found for the provided query")
+        if self.debug_snapshot:
+            self.write_snapshot(records, file_suffix)
+        return records
+
+    def bulk_stop_positions(self, load_numbers: List[str]) -> pd.DataFrame:
+        """Lookup стопов через Bulk query с PK chunking; строки фильтруются по нужным грузам по мере чтения.
+
+        Запрос ограничен диапазоном номеров грузов выгрузки и BULK_QUERY_LOOKBACK_DAYS днями.
+        """
+        wanted = set(load_numbers)
+        # Строковый диапазон номеров: не отсекает ни один нужный груз, но не выгружает весь org
+        condition = (f'LOAD__r.Load_Number__c >= {self.quote_soql(min(wanted))} '
+                     f'AND LOAD__r.Load_Number__c <= {self.quote_soql(max(wanted))}')
+        if BULK_QUERY_LOOKBACK_DAYS:
+            condition += f' AND LOAD__r.CreatedDate = LAST_N_DAYS:{BULK_QUERY_LOOKBACK_DAYS}'
+        frames = [
+            chunk[chunk['LOAD__r.Load_Number__c'].isin(wanted)]
+            for chunk in self.run_bulk_query('Stop_Position__c', STOP_POSITIONS_BULK_QUERY.format(condition=condition),
+                                             usecols=['Id', 'TYPE__c', 'LOAD__r.Load_Number__c'])
+        ]
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            logger.warning("No records found for the provided query")
+            return pd.DataFrame(columns=STOP_COLUMNS)
+        return pivot_stop_rows(pd.concat(frames, ignore_index=True))
+
+    def fetch_lookup(self, table: str, query_template: str, key_field: str, flatten,
+                     values: List[str], file_suffix: str) -> pd.DataFrame:
+        """Запрашивает lookup по ключам: REST запросы с IN (...) или, для больших наборов стопов, Bulk query.
+
+        Техника водителей всегда идёт через REST: Bulk query не выполняет подзапрос Vehicle_History__r.
+        """
+        values = list(dict.fromkeys(str(v) for v in values if v is not None and pd.notna(v) and str(v) != ''))
+        if table == 'stop_positions' and BULK_QUERY_THRESHOLD and len(values) >= BULK_QUERY_THRESHOLD:
+            logger.info(f"Using Bulk API query for {len(values)} load numbers")
+            return self.bulk_stop_positions(values)
+        template = query_template.format(condition=f'{key_field} IN ({{load_numbers_str}})')
+        return flatten(self.execute_batched_query(template, values, file_suffix=file_suffix))
+
+    def sync_reference(self, table: str, query_template: str, key_field: str, flatten,
+                       values: List[str], file_suffix: str) -> pd.DataFrame:
+        """Обновляет локальный кэш и отдаёт lookup из него.
+
+        1. Изменения закэшированных ключей выгрузки забираются IN запросами по SystemModstamp
+           с самого раннего synced_at среди них: стоимость зависит от выгрузки, а не от активности org.
+        2. Отсутствующие или устаревшие (старше REFERENCE_MAX_AGE) ключи догружаются через IN.
+        """
+        store = self.reference_store
+        values = list(dict.fromkeys(str(v) for v in values if v is not None and pd.notna(v) and str(v) != ''))
+        sync_started = datetime.now(timezone.utc) - SYNC_CLOCK_SKEW
+
+        missing = store.stale_keys(table, values, REFERENCE_MAX_AGE[table])
+        stale = set(missing)
+        cached = [value for value in values if value not in stale]
+        since = store.oldest_sync(table, cached) if cached else None
+        if since:
+            condition = f"{key_field} IN ({{load_numbers_str}}) AND {REFERENCE_DELTA_CONDITIONS[table].format(since=since)}"
+            changed = flatten(self.run_chunked_query(query_template.format(condition=condition), cached))
+            logger.info(f"Reference cache {table}: {store.upsert(table, changed, sync_started)} of {len(cached)} "
+                        f"cached keys changed since {since}")
+
+        if missing:
+            fetched = self.fetch_lookup(table, query_template, key_field, flatten, missing, file_suffix)
+            store.upsert(table, fetched, sync_started)
+        logger.info(f"Reference cache {table}: {len(values) - len(missing)} of {len(values)} keys served locally")
+        return store.get_frame(table, values)
+
+    def making_trip_sql_request(self, load_numbers: List[str]) -> Optional[pd.DataFrame]:
+        """Возвращает Id стопов Pickup/Delivery по номерам грузов (load, pickup_id, delivery_id)."""
         try:
-            os.makedirs(self.save_folder, exist_ok=True)
             if not self.sf_rest_session:
                 raise Exception('Salesforce REST session not initialized')
 
-            query_template = """
-                SELECT Id, Load_Number__c, (SELECT Id, TYPE__c FROM Stop_Positions__r) 
-                FROM Load__c 
-                WHERE Load_Number__c IN ({load_numbers_str})
-            """
-            return self.execute_batched_query(query_template, load_numbers, batch_size=200, file_suffix='stop_pos_id')
+            with metrics.stage('lookup.stop_positions') as stage:
+                stage.rows_in = len(load_numbers)
+                if self.reference_store is not None:
+                    lookup = self.sync_reference('stop_positions', STOP_POSITIONS_QUERY, 'Load_Number__c',
+                                                 flatten_stop_positions, load_numbers, file_suffix='stop_pos_id')
+                else:
+                    lookup = self.fetch_lookup('stop_positions', STOP_POSITIONS_QUERY, 'Load_Number__c',
+                                               flatten_stop_positions, load_numbers, file_suffix='stop_pos_id')
+                stage.rows_out = len(lookup)
+            return lookup
 
         except Exception as e:
             logger.error(f"Error occurred during trip SQL request: {str(e)}")
             return None
 
-    def making_driver_sql_request(self, load_numbers: List[str]) -> Optional[str]:
-        """Скачивает CSV с информацией о водителях."""
+    def making_driver_sql_request(self, load_numbers: List[str]) -> Optional[pd.DataFrame]:
+        """Возвращает текущие траки и трейлеры водителей (driver_id, vehicle_type, unit_id, vehicle_id)."""
         try:
-            os.makedirs(self.save_folder, exist_ok=True)
             if not self.sf_rest_session:
                 raise Exception('Salesforce REST session not initialized')
 
-            query_template = """
-                SELECT Id, DRIVER_ID__c, FirstName, LastName, 
-                (SELECT Id, TYPE__c, END_DATE__c, UNIT__c FROM Vehicle_History__r WHERE END_DATE__c = null) 
-                FROM Account 
-                WHERE RecordType.DeveloperName = 'DriverAccount'
-                AND DRIVER_ID__c IN ({load_numbers_str})
-            """
-            return self.execute_batched_query(query_template, load_numbers, batch_size=200, file_suffix='driver_id')
+            with metrics.stage('lookup.driver_vehicles') as stage:
+                stage.rows_in = len(load_numbers)
+                if self.reference_store is not None:
+                    lookup = self.sync_reference('driver_vehicles', DRIVER_VEHICLES_QUERY, 'DRIVER_ID__c',
+                                                 flatten_vehicle_history, load_numbers, file_suffix='driver_id')
+                else:
+                    lookup = self.fetch_lookup('driver_vehicles', DRIVER_VEHICLES_QUERY, 'DRIVER_ID__c',
+                                               flatten_vehicle_history, load_numbers, file_suffix='driver_id')
+                stage.rows_out = len(lookup)
+            return lookup
 
         except Exception as e:
             logger.error(f"Error occurred during driver SQL request: {str(e)}")
             return None
-    
-
-    
\ No newline at end of file
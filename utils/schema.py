@@ -0,0 +1,71 @@
+import logging
+from typing import Dict, List
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow  # noqa: F401
+    STRING_DTYPE = pd.StringDtype('pyarrow')
+except ImportError:
+    STRING_DTYPE = pd.StringDtype()
+
+# Низкая кардинальность: словарь значений плюс коды
+CATEGORY_COLUMNS = ['status', 'customer', 'pu_state_code', 'del_state_code', 'vehicle_type', 'source']
+NUMERIC_COLUMNS = ['linehaul_total', 'lumper', 'empty_miles', 'loaded_miles']
+STRING_COLUMNS = [
+    'load', 'driver_id', 'driver', 'pu_info', 'del_info', 'pu_city', 'del_city', 'pu_time', 'del_time',
+    'pu_street', 'del_street', 'pu_zip', 'del_zip',
+    'pickup_id', 'delivery_id', 'unit_id', 'vehicle_id',
+]
+
+# Колонка -> dtype для DataSet.df и lookup таблиц TripDataset; колонки, которых нет в кадре, пропускаются
+DATASET_SCHEMA: Dict[str, object] = {
+    **{column: 'category' for column in CATEGORY_COLUMNS},
+    **{column: 'float64' for column in NUMERIC_COLUMNS},
+    **{column: STRING_DTYPE for column in STRING_COLUMNS},
+}
+
+
+def to_numeric(series: pd.Series, column: str) -> pd.Series:
+    """Числовая колонка; нераспознанные значения становятся NaN с одной записью в лог."""
+    values = pd.to_numeric(series, errors='coerce')
+    invalid = values.isna() & series.notna()
+    if invalid.any():
+        logger.error(f"{int(invalid.sum())} values in '{column}' are not numeric, e.g. {series[invalid].iloc[0]!r}")
+    return values.astype('float64')
+
+
+def apply_schema(df: pd.DataFrame, schema: Dict[str, object] = DATASET_SCHEMA) -> pd.DataFrame:
+    """Приводит колонки к dtype схемы один раз при загрузке; уже приведённые колонки не трогает."""
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            continue
+        if dtype == 'category':
+            # 'category' совпадает с любым CategoricalDtype: parquet возвращает категории как str, приводим их к STRING_DTYPE
+            if not isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(STRING_DTYPE).astype('category')
+            elif df[column].cat.categories.dtype != STRING_DTYPE:
+                categories = df[column].cat.categories
+                df[column] = df[column].cat.rename_categories(categories.astype(STRING_DTYPE))
+            continue
+        if df[column].dtype == dtype:
+            continue
+        if dtype == 'float64':
+            df[column] = to_numeric(df[column], column)
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def concat_frames(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """pd.concat без потери category: категории кадров объединяются заранее, иначе concat вернёт object."""
+    frames = [frame for frame in frames if frame is not None]
+    if len(frames) > 1:
+        for column in CATEGORY_COLUMNS:
+            if not all(column in frame.columns and isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames):
+                continue
+            categories = frames[0][column].cat.categories.append([frame[column].cat.categories for frame in frames[1:]]).unique()
+            frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,138 @@
+import functools
+import json
+import logging
+import os
+import time
+import types
+from typing import Callable, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from salesforce_bulk import SalesforceBulk
+from salesforce_bulk import salesforce_bulk as bulk_module
+from salesforce_bulk.salesforce_bulk import BulkApiError
+
+logger = logging.getLogger(__name__)
+
+SESSION_CACHE_PATH = os.getenv('SF_SESSION_CACHE', 'set/.sf_session.json')
+HTTP_POOL_SIZE = int(os.getenv('SF_HTTP_POOL_SIZE', '16'))
+# Ответ Bulk API на протухшую сессию: <exceptionCode>InvalidSessionId</exceptionCode>
+EXPIRED_SESSION_MARKERS = ('InvalidSessionId', 'INVALID_SESSION_ID')
+
+
+def create_http_session(pool_size: int = HTTP_POOL_SIZE) -> requests.Session:
+    """Один keep-alive пул соединений на REST и Bulk клиентов."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class _SessionRequests:
+    """Заменяет имя requests в методах SalesforceBulk конкретного клиента: библиотека вызывает requests.get/post напрямую."""
+
+    def __init__(self, session: requests.Session):
+        self.session = session
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.session.post(url, data=data, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+
+def load_cached_session(username: str, path: str = SESSION_CACHE_PATH) -> Optional[Tuple[str, str]]:
+    """session id и instance из дискового кэша, если он выписан на того же пользователя."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Session cache {path} is unreadable: {e}")
+        return None
+    if cached.get('username') != username or not cached.get('session_id') or not cached.get('instance'):
+        return None
+    return cached['session_id'], cached['instance']
+
+
+def save_cached_session(username: str, session_id: str, instance: str, path: str = SESSION_CACHE_PATH):
+    """Пишет кэш с правами 0600: session id равнозначен паролю."""
+    try:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.chmod(path, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'username': username, 'session_id': session_id, 'instance': instance,
+                       'saved_at': int(time.time())}, f)
+    except Exception as e:
+        logger.warning(f"Could not write session cache {path}: {e}")
+
+
+def clear_cached_session(path: str = SESSION_CACHE_PATH):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def is_expired_session_error(error: Exception) -> bool:
+    return any(marker in str(error) for marker in EXPIRED_SESSION_MARKERS)
+
+
+def _reauth_on_expiry(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # Позиции файловых аргументов (post_batch), чтобы повтор отправил батч с начала
+        positions = [(arg, arg.tell()) for arg in args if hasattr(arg, 'seek') and hasattr(arg, 'tell')]
+        try:
+            return method(self, *args, **kwargs)
+        except BulkApiError as e:
+            if self.reauthenticate is None or not is_expired_session_error(e):
+                raise
+            logger.warning(f"Bulk session expired during {method.__name__}, re-authenticating")
+            self.sessionId = self.reauthenticate(self.sessionId)
+            for arg, position in positions:
+                arg.seek(position)
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# Методы SalesforceBulk, которые ходят в сеть
+HTTP_METHODS = ('create_job', 'close_job', 'abort_job', 'post_batch', 'batch_status', 'job_status',
+                'get_batch_list', 'get_batch_results', 'query', 'get_query_batch_request',
+                'get_query_batch_result_ids', 'get_query_batch_results', 'post_mapping_file')
+
+
+def _bind_session(method, namespace: dict):
+    """Копия метода salesforce_bulk с глобальным пространством имён namespace вместо модульного."""
+    bound = types.FunctionType(method.__code__, namespace, method.__name__, method.__defaults__, method.__closure__)
+    bound.__kwdefaults__ = method.__kwdefaults__
+    return functools.update_wrapper(bound, method)
+
+
+class ReauthSalesforceBulk(SalesforceBulk):
+    """SalesforceBulk, который при InvalidSessionId получает новую сессию через reauthenticate и повторяет вызов.
+
+    С session запросы клиента идут через неё (общий keep-alive пул с REST), модуль salesforce_bulk не меняется.
+    """
+
+    def __init__(self, *args, session: Optional[requests.Session] = None,
+                 reauthenticate: Optional[Callable[[str], str]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reauthenticate = reauthenticate
+        self.session = session
+        if session is not None:
+            namespace = dict(vars(bulk_module), requests=_SessionRequests(session))
+            for name in HTTP_METHODS:
+                method = _bind_session(getattr(SalesforceBulk, name), namespace)
+                setattr(self, name, types.MethodType(_reauth_on_expiry(method), self))
+
+
+for _name in HTTP_METHODS:
+    setattr(ReauthSalesforceBulk, _name, _reauth_on_expiry(getattr(SalesforceBulk, _name)))